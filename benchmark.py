@@ -0,0 +1,673 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from multiprocessing import Pool, get_context
+
+import numpy as np
+from PIL import Image, ImageChops, ImageEnhance
+
+from modules.Backends import BACKEND_KERNELS, BACKEND_TOLERANCE, BACKENDS, calibrate_backends, calibration_data, \
+    check_backend, kernel_calls
+from modules.Batch import find_texture_sets, process_texture_set, processing_options, run_batch, summarize
+from modules.Config import CFG
+from modules.Display import DisplayCache
+from modules.Manifest import BuildManifest
+from modules.Memory import calibrate_memory_model, estimate_peak_memory
+from modules.PBR import PBRSet, proxy_textures
+from modules.Pipeline import run_pipeline, stage_report
+from modules.Report import run_report
+from modules.Shared import SharedExecutor, attach
+from modules.Stack import correct_stack, verify_stack
+from modules.Textures import TextureStore
+from modules.ImageProcessing import RANGE_KERNELS, TRANSFER_FUNCTIONS, correct_range_tiled, apply_by_mask, \
+    blend_by_mask, unclamp_brightness_data, compensation_factors, compensate_roughness, verify_range_tiled, \
+    verify_statistics_tiled
+
+LIMIT_VALUES = [8, 235, 52]
+
+
+def random_texture(size, channels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (size, size, channels), dtype=np.uint8)
+
+
+def palette_texture(size, colors=64, seed=0):
+    # flat blocks of a few colors, like hand-painted or stylized skins
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (colors, 3), dtype=np.uint8)
+    blocks = rng.integers(0, colors, (size // 32 + 1, size // 32 + 1))
+
+    return palette[np.kron(blocks, np.ones((32, 32), dtype=int))[:size, :size]]
+
+
+def photo_texture(size, seed=0):
+    # smooth gradients with sensor-like noise, nearly every pixel is a distinct color
+    rng = np.random.default_rng(seed)
+    rows, columns = np.meshgrid(np.linspace(0, 255, size), np.linspace(0, 255, size), indexing="ij")
+    image_data = np.stack((rows, columns, (rows + columns) / 2), axis=-1)
+
+    return np.clip(image_data + rng.normal(0, 6, image_data.shape), 0, 255).astype(np.uint8)
+
+
+def measure(function, repeat=3):
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def report(name, seconds, pixels, baseline=None):
+    line = f"{name:<36}{seconds * 1000:>10.1f} ms{pixels / seconds / 1e6:>10.1f} MP/s"
+    if baseline is not None:
+        line += f" {baseline / seconds:>8.2f}x"
+    print(line)
+
+
+def benchmark_kernels(args):
+    image_data = random_texture(args.size)
+    pixels = args.size * args.size
+    baseline = None
+
+    for kernel in RANGE_KERNELS:
+        for transfer in TRANSFER_FUNCTIONS:
+            seconds = measure(lambda: correct_range_tiled(image_data, LIMIT_VALUES, kernel=kernel,
+                                                          transfer=transfer), args.repeat)
+            baseline = baseline or seconds
+            report(f"correct_range {kernel} {transfer}", seconds, pixels, baseline)
+
+
+def benchmark_transfer(args):
+    image_data = np.clip(random_texture(args.size), 1, 255).astype(np.float32)
+    linear_data = np.random.default_rng(1).random(image_data.shape) * 255
+    pixels = args.size * args.size
+
+    exact_decode, exact_encode = TRANSFER_FUNCTIONS["exact"]
+    decoded = exact_decode(image_data)
+    encoded = exact_encode(linear_data)
+
+    for transfer, (decode, encode) in TRANSFER_FUNCTIONS.items():
+        seconds = measure(lambda: decode(image_data), args.repeat)
+        report(f"decode {transfer}", seconds, pixels)
+        print(f"    max difference {np.abs(decode(image_data) - decoded).max():.6f}")
+
+        seconds = measure(lambda: encode(linear_data), args.repeat)
+        report(f"encode {transfer}", seconds, pixels)
+        print(f"    max difference {np.abs(encode(linear_data) - encoded).max():.6f}")
+
+
+def benchmark_mask(args):
+    image_data = random_texture(args.size)
+    pixels = args.size * args.size
+    rng = np.random.default_rng(2)
+
+    def dense():
+        return blend_by_mask(image_data, unclamp_brightness_data(image_data, LIMIT_VALUES[2]), mask_data)
+
+    def sparse():
+        return apply_by_mask(image_data, mask_data, unclamp_brightness_data, LIMIT_VALUES[2])
+
+    # binary metallic masks with a thin band of partially covered pixels, as painted Gunsmith masks usually are,
+    # and soft masks where half of the covered pixels are only partially covered
+    for softness in [0.0, 0.5]:
+        for coverage in [0.0, 0.05, 0.25, 0.5, 0.75, 1.0]:
+            covered = rng.random((args.size, args.size)) < coverage
+            soft = rng.random((args.size, args.size)) < softness
+            mask_data = np.where(covered, np.where(soft, rng.integers(1, 255, covered.shape), 255), 0).astype(np.uint8)
+            mask_data[:args.size // 100] = 128
+
+            baseline = measure(dense, args.repeat)
+            report(f"combined dense {coverage:.0%} {softness:.0%} soft", baseline, pixels)
+            report(f"combined sparse {coverage:.0%} {softness:.0%} soft", measure(sparse, args.repeat), pixels,
+                   baseline)
+
+
+def benchmark_palette(args):
+    # a small texture stays on the dense kernels without counting its colors
+    for name, image_data in [("palette", palette_texture(args.size)), ("photo", photo_texture(args.size)),
+                             ("small photo", photo_texture(128))]:
+        albedo = Image.fromarray(image_data)
+        pixels = albedo.width * albedo.height
+        baseline = None
+
+        for engine in ["dense", "palette", "auto"]:
+            pbr_set = PBRSet(albedo, engine=engine)
+            seconds = measure(lambda: pbr_set.correct_albedo("metallic", LIMIT_VALUES), args.repeat)
+            baseline = baseline or seconds
+            report(f"{name} texture {engine}", seconds, pixels, baseline)
+
+
+def benchmark_lut(args):
+    albedo = Image.fromarray(photo_texture(args.size))
+    pixels = args.size * args.size
+
+    baseline = measure(lambda: PBRSet(albedo).correct_albedo("metallic", LIMIT_VALUES), args.repeat)
+    report("dense", baseline, pixels)
+
+    for lut_size in [256, 65, 33]:
+        pbr_set = PBRSet(albedo, engine="lut", lut_size=lut_size)
+        start = time.perf_counter()
+        pbr_set.correct_albedo("metallic", LIMIT_VALUES)
+        print(f"    lut {lut_size} baked and applied in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        seconds = measure(lambda: pbr_set.correct_albedo("metallic", LIMIT_VALUES), args.repeat)
+        report(f"lut {lut_size} cached", seconds, pixels, baseline)
+
+
+def benchmark_incremental(args):
+    rng = np.random.default_rng(3)
+    albedo = Image.fromarray(photo_texture(args.size))
+    metallic = Image.fromarray(rng.integers(0, 256, (args.size, args.size), dtype=np.uint8))
+    roughness = Image.fromarray(random_texture(args.size))
+    pixels = args.size * args.size
+
+    # the parameter a slider drag changes on every step
+    changes = [
+        ("compensation_coefficient", lambda step: ([8, 235, 52], 1.0 - step / 100)),
+        ("brightness_limit", lambda step: ([8, 235, 52 + step], 1.0)),
+        ("luminance_min", lambda step: ([8 + step, 235, 52], 1.0)),
+    ]
+
+    for name, parameters in changes:
+        pbr_set = PBRSet(albedo, metallic, roughness, incremental=True)
+        pbr_set.correct_albedo("combined", *parameters(0), True)
+        steps = iter(range(1, 1000))
+
+        def full():
+            limit_values, coefficient = parameters(next(steps))
+            PBRSet(albedo, metallic, roughness).correct_albedo("combined", limit_values, True, coefficient)
+
+        def incremental():
+            limit_values, coefficient = parameters(next(steps))
+            pbr_set.correct_albedo("combined", limit_values, True, coefficient)
+
+        baseline = measure(full, args.repeat)
+        report(f"{name} full", baseline, pixels)
+        report(f"{name} incremental", measure(incremental, args.repeat), pixels, baseline)
+
+
+def benchmark_preview(args):
+    rng = np.random.default_rng(4)
+    albedo = Image.fromarray(photo_texture(args.size))
+    metallic = Image.fromarray(rng.integers(0, 256, (args.size, args.size), dtype=np.uint8))
+    pixels = args.size * args.size
+    steps = iter(range(1000))
+
+    baseline = measure(lambda: PBRSet(albedo, metallic).correct_albedo("combined", LIMIT_VALUES), args.repeat)
+    report("full resolution", baseline, pixels)
+
+    start = time.perf_counter()
+    proxy_set = PBRSet(*proxy_textures(albedo, metallic), incremental=True)
+    print(f"    proxy {proxy_set.albedo_image.size[0]}px built in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    seconds = measure(lambda: proxy_set.correct_albedo("combined", [8, 235, 40 + next(steps) % 20]), args.repeat)
+    report("proxy brightness_limit change", seconds, pixels, baseline)
+
+
+def benchmark_display(args):
+    albedo = Image.fromarray(photo_texture(args.size))
+    ao = Image.fromarray(random_texture(args.size, 1)[..., 0])
+    pixels = args.size * args.size
+
+    # what the GUI did on each AO toggle before the Qt conversion and scaling
+    def full_resolution():
+        image = ImageChops.multiply(albedo.convert("RGB"), ao.convert("RGB")).convert("RGBA")
+        image.putalpha(Image.new('L', image.size, 255))
+        return image.resize((650, 650), Image.Resampling.BILINEAR)
+
+    baseline = measure(full_resolution, args.repeat)
+    report("toggle ao full resolution", baseline, pixels)
+
+    display_cache = DisplayCache()
+    start = time.perf_counter()
+    display_cache.view(display_cache.ambient_occlusion(albedo, ao))
+    report("toggle ao first proxy", time.perf_counter() - start, pixels, baseline)
+
+    seconds = measure(lambda: (display_cache.view(albedo), display_cache.view(display_cache.ambient_occlusion(albedo, ao))),
+                      args.repeat)
+    report("toggle ao cached", seconds, pixels, baseline)
+
+
+def benchmark_textures(args):
+    pixels = args.size * args.size
+
+    with tempfile.TemporaryDirectory() as directory:
+        for extension, options in [("tga", {"compression": "tga_rle"}), ("png", {})]:
+            path = os.path.join(directory, f"albedo.{extension}")
+            Image.fromarray(photo_texture(args.size)).save(path, **options)
+
+            def decode():
+                with Image.open(path) as image:
+                    return np.asarray(image)
+
+            baseline = measure(decode, args.repeat)
+            report(f"{extension} decode", baseline, pixels)
+
+            store_directory = os.path.join(directory, "store")
+            TextureStore(store_directory).open(path)
+            # copied out of the mapping so every page is actually read
+            seconds = measure(lambda: np.array(TextureStore(store_directory).open(path)), args.repeat)
+            report(f"{extension} reopen from the decoded cache", seconds, pixels, baseline)
+
+            store = TextureStore()
+            store.open(path)
+            report(f"{extension} reopen in memory", measure(lambda: store.open(path), args.repeat), pixels, baseline)
+
+
+def benchmark_compensation(args):
+    albedo_data = photo_texture(args.size)
+    corrected_data = correct_range_tiled(albedo_data, LIMIT_VALUES)
+    roughness_data = random_texture(args.size, seed=5)
+    albedo, corrected, roughness = map(Image.fromarray, (albedo_data, corrected_data, roughness_data))
+    pixels = args.size * args.size
+    coefficient = 0.9
+
+    # the ImageChops and ImageEnhance chain PBRSet.correct_albedo used before
+    def chained():
+        lightening_factor = ImageChops.subtract(corrected, albedo).convert("L")
+        darkening_factor = ImageChops.subtract(albedo, corrected).convert("L")
+        lightening_factor = ImageEnhance.Contrast(lightening_factor).enhance(coefficient ** 3.14)
+        darkening_factor = ImageEnhance.Contrast(darkening_factor).enhance(coefficient ** 3.14)
+        compensated = ImageChops.subtract(roughness, lightening_factor.convert("RGB"))
+        return ImageChops.add(compensated, darkening_factor.convert("RGB"))
+
+    def vectorized():
+        return compensate_roughness(roughness_data, *compensation_factors(albedo_data, corrected_data), coefficient)
+
+    baseline = measure(chained, args.repeat)
+    report("compensation chained", baseline, pixels)
+    report("compensation vectorized", measure(vectorized, args.repeat), pixels, baseline)
+    print(f"    pixels differing from the chain: {(vectorized() != np.asarray(chained())).any(axis=-1).sum()}")
+
+
+def benchmark_threads(args):
+    image_data = photo_texture(args.size)
+    roughness_data = random_texture(args.size, seed=6)
+    pixels = args.size * args.size
+    cores = os.cpu_count() or 1
+    counts = sorted({1, cores} | {2 ** power for power in range(1, cores.bit_length()) if 2 ** power < cores})
+
+    stages = [
+        ("correct", lambda workers: correct_range_tiled(image_data, LIMIT_VALUES, workers=workers)),
+        ("verify", lambda workers: verify_range_tiled(image_data, LIMIT_VALUES, workers=workers)),
+        ("compensate", lambda workers: compensate_roughness(
+            roughness_data, *compensation_factors(image_data, image_data[::-1], workers=workers), 0.9,
+            workers=workers)),
+    ]
+
+    for name, stage in stages:
+        baseline = None
+
+        for workers in counts:
+            seconds = measure(lambda: stage(workers), args.repeat)
+            baseline = baseline or seconds
+            report(f"{name} {workers} threads", seconds, pixels, baseline)
+
+
+def verify_pickled(arrays):
+    albedo_data, metallic_data = arrays
+    pbr_set = PBRSet(Image.fromarray(albedo_data), Image.fromarray(metallic_data))
+    pbr_set.verify_albedo(LIMIT_VALUES, "combined")
+
+    return np.asarray(pbr_set.albedo_verified)
+
+
+def pickled_round_trip(arrays):
+    # an empty job, the inputs are pickled to the worker and an overlay sized array is pickled back
+    return np.empty_like(arrays[0])
+
+
+def shared_round_trip(job):
+    inputs, output = job
+    return [attach(descriptor).shape for descriptor in inputs + [output]]
+
+
+def benchmark_shared(args):
+    jobs = [(random_texture(args.size, seed=seed), random_texture(args.size, 1, seed=seed)[..., 0]) for seed in range(4)]
+    pixels = args.size * args.size * len(jobs)
+
+    baseline = measure(lambda: [verify_pickled(job) for job in jobs], args.repeat)
+    report(f"{len(jobs)} verifications in process", baseline, pixels)
+
+    with Pool(2) as pool:
+        seconds = measure(lambda: pool.map(verify_pickled, jobs), args.repeat)
+        report("pickled to 2 processes", seconds, pixels, baseline)
+
+        # the transfer cost on its own, the same jobs without any work in the worker
+        seconds = measure(lambda: pool.map(pickled_round_trip, jobs), args.repeat)
+        report("    empty jobs pickled", seconds, pixels)
+
+    with SharedExecutor(2) as executor:
+        def shared():
+            submitted = [executor.submit("verify", Image.fromarray(albedo_data), Image.fromarray(metallic_data),
+                                         mode="combined", limit_values=LIMIT_VALUES)
+                         for albedo_data, metallic_data in jobs]
+            for job in submitted:
+                executor.wait(job)
+                executor.release(job)
+
+        seconds = measure(shared, args.repeat)
+        report("shared memory to 2 processes", seconds, pixels, baseline)
+
+        def shared_empty():
+            buffers = executor.buffers
+            submitted = []
+            for arrays in jobs:
+                inputs = [buffers.share(image_data) for image_data in arrays]
+                output = buffers.empty(arrays[0].shape)
+                submitted.append((inputs, output, executor.pool.apply_async(shared_round_trip, ((inputs, output),))))
+
+            for inputs, output, result in submitted:
+                result.get()
+                buffers.array(output)
+                for descriptor in inputs + [output]:
+                    buffers.release(descriptor)
+
+        seconds = measure(shared_empty, args.repeat)
+        report("    empty jobs in shared memory", seconds, pixels)
+        print(f"    {len(executor.buffers.blocks)} blocks reused across runs")
+
+
+def benchmark_pipeline(args):
+    cfg = CFG("config.cfg")
+    cfg.mode = "combined"
+    cfg.is_compensating = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(6):
+            Image.fromarray(photo_texture(args.size, seed=index)).save(os.path.join(directory, f"{index}_albedo.png"))
+            Image.fromarray(random_texture(args.size, 1, seed=index)[..., 0]).save(
+                os.path.join(directory, f"{index}_metallic.png"))
+            Image.fromarray(random_texture(args.size, seed=index)).save(os.path.join(directory, f"{index}_roughness.png"))
+
+        texture_sets = find_texture_sets([directory])
+        pixels = args.size * args.size * len(texture_sets)
+        output_dir = os.path.join(directory, "output")
+        os.makedirs(output_dir)
+
+        _, baseline = run_batch(texture_sets, cfg, "correct", output_dir, workers=1)
+        report(f"{len(texture_sets)} sets one after another", baseline, pixels)
+
+        for io_threads in [1, 2]:
+            _, seconds, stages = run_pipeline(texture_sets, cfg, "correct", output_dir, io_threads)
+            report(f"{len(texture_sets)} sets pipelined, {io_threads} io threads", seconds, pixels, baseline)
+            print("    " + stage_report(stages, seconds).replace("\n", "\n    "))
+
+
+def job_peak_memory(job):
+    # peak resident memory of a fresh process running one batch job, the quantity the scheduler budgets;
+    # VmHWM belongs to the address space of the process, ru_maxrss would keep the peak of the parent it forked from
+    process_texture_set(*job)
+
+    with open("/proc/self/status") as status:
+        return next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:"))
+
+
+def benchmark_memory(args):
+    # the estimate the scheduler admits jobs by, with the options of the config, against the peak of a worker
+    cfg = CFG("config.cfg")
+    cfg.threads = 1
+    model = calibrate_memory_model(tuple(sorted(processing_options(cfg).items())))
+    pixels = args.size * args.size
+
+    with tempfile.TemporaryDirectory() as directory:
+        rng = np.random.default_rng(7)
+        Image.fromarray(random_texture(args.size)).save(os.path.join(directory, "set_albedo.tga"))
+        Image.fromarray(rng.integers(0, 256, (args.size, args.size), dtype=np.uint8)).save(
+            os.path.join(directory, "set_metallic.tga"))
+        Image.fromarray(random_texture(args.size)).save(os.path.join(directory, "set_roughness.tga"))
+        texture_set, = find_texture_sets([directory], cfg.texture_patterns)
+        output_dir = os.path.join(directory, "output")
+        os.makedirs(output_dir)
+
+        for task, mode, is_compensating in [("correct", "combined", True), ("correct", "nonmetallic", False),
+                                            ("verify", "combined", False)]:
+            cfg.mode = mode
+            cfg.is_compensating = is_compensating
+
+            with get_context("spawn").Pool(1) as pool:
+                peak = pool.apply(job_peak_memory, ((texture_set, cfg, task, output_dir),))
+
+            estimate = estimate_peak_memory(pixels, task, mode, is_compensating, model)
+            print(f"{task} {mode:<12} measured {peak / 2 ** 20:>8.1f} MB, modeled {estimate / 2 ** 20:>8.1f} MB "
+                  f"({estimate / peak - 1:+.1%})")
+
+
+def benchmark_manifest(args):
+    # a library of small sets, the check has to stay cheap next to correcting even tiny textures
+    cfg = CFG("config.cfg")
+    count = 1000
+
+    with tempfile.TemporaryDirectory() as directory:
+        albedo = Image.fromarray(photo_texture(64))
+        metallic = Image.fromarray(random_texture(64, 1)[..., 0])
+        roughness = Image.fromarray(random_texture(64))
+        for index in range(count):
+            albedo.save(os.path.join(directory, f"{index}_albedo.tga"))
+            metallic.save(os.path.join(directory, f"{index}_metallic.tga"))
+            roughness.save(os.path.join(directory, f"{index}_roughness.tga"))
+
+        texture_sets = find_texture_sets([directory], cfg.texture_patterns)
+        pixels = 64 * 64 * len(texture_sets)
+        results, baseline = run_batch(texture_sets, cfg, "correct", workers=1)
+        assert all(result.error is None for result in results)
+        report(f"{count} sets corrected", baseline, pixels)
+
+        manifest = BuildManifest(cfg, hash_inputs=True)
+        for result in results:
+            manifest.record(result.texture_set)
+        manifest.save()
+
+        def rebuild(hash_inputs=False):
+            stale = BuildManifest(cfg, hash_inputs=hash_inputs).stale(
+                find_texture_sets([directory], cfg.texture_patterns))
+            assert not stale
+
+        report(f"{count} sets up to date", measure(rebuild, args.repeat), pixels, baseline)
+
+        for texture_set in texture_sets:
+            os.utime(texture_set.albedo_path)
+        report(f"{count} sets touched, hashed", measure(lambda: rebuild(True), 1), pixels, baseline)
+
+
+def benchmark_cache(args):
+    # the same batch twice with a cache directory, the second run reads every result back instead of correcting
+    cfg = CFG("config.cfg")
+    cfg.mode = "metallic"
+    cfg.is_compensating = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(4):
+            Image.fromarray(photo_texture(args.size, seed=index)).save(os.path.join(directory, f"{index}_albedo.tga"))
+            Image.fromarray(random_texture(args.size, seed=index)).save(
+                os.path.join(directory, f"{index}_roughness.tga"))
+
+        texture_sets = find_texture_sets([directory], cfg.texture_patterns)
+        pixels = args.size * args.size * len(texture_sets)
+        output_dir = os.path.join(directory, "output")
+        os.makedirs(output_dir)
+
+        results, baseline = run_batch(texture_sets, cfg, "correct", output_dir, workers=1)
+        report(f"{len(texture_sets)} sets without a cache", baseline, pixels)
+
+        cfg.cache_directory = os.path.join(directory, "cache")
+        for run in ["first", "repeated"]:
+            results, seconds = run_batch(texture_sets, cfg, "correct", output_dir, workers=1)
+            report(f"{len(texture_sets)} sets, {run} run", seconds, pixels, baseline)
+            print(f"    {summarize(results, seconds)}")
+
+
+def benchmark_verify(args):
+    image_data = photo_texture(args.size)
+    pixels = args.size * args.size
+
+    def overlay_count():
+        verified_data = verify_range_tiled(image_data, LIMIT_VALUES, 256)
+        return ((verified_data == [255, 0, 0]) | (verified_data == [0, 0, 255])).all(axis=2).sum()
+
+    def statistics():
+        return verify_statistics_tiled(image_data, LIMIT_VALUES, 256)[0]
+
+    baseline = measure(overlay_count, args.repeat)
+    report("overlay and color count", baseline, pixels)
+    report("statistics only", measure(statistics, args.repeat), pixels, baseline)
+    report("statistics and masks", measure(lambda: verify_statistics_tiled(image_data, LIMIT_VALUES, 256, masks=True),
+                                           args.repeat), pixels, baseline)
+
+    tracemalloc.start()
+    overlay_count()
+    overlay_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    result = statistics()
+    statistics_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"peak memory {overlay_peak / 2 ** 20:.1f} MB with the overlay, {statistics_peak / 2 ** 20:.1f} MB without, "
+          f"{result['below'] + result['above']} mismatched pixels")
+
+
+def benchmark_report(args):
+    cfg = CFG("config.cfg")
+    cfg.mode = "nonmetallic"
+
+    with tempfile.TemporaryDirectory() as directory:
+        # mostly compliant textures, one in four has a dark region the pre-pass has to catch
+        for index in range(8):
+            image_data = photo_texture(args.size, seed=index) // 2 + 100
+            if index % 4 == 0:
+                image_data[:args.size // 8] = 0
+            Image.fromarray(image_data).save(os.path.join(directory, f"{index}_albedo.tga"))
+
+        texture_sets = find_texture_sets([directory])
+        pixels = args.size * args.size * len(texture_sets)
+        report_path = os.path.join(directory, "report.jsonl")
+
+        baseline = measure(lambda: run_report(texture_sets, cfg, report_path, 1, prepass_size=0), args.repeat)
+        report(f"{len(texture_sets)} sets at full size", baseline, pixels)
+
+        summary = run_report(texture_sets, cfg, report_path, 1, prepass_size=256)
+        seconds = measure(lambda: run_report(texture_sets, cfg, report_path, 1, prepass_size=256), args.repeat)
+        report(f"{len(texture_sets)} sets, {summary['full']} after the pre-pass", seconds, pixels, baseline)
+
+
+def benchmark_masks(args):
+    albedo = Image.fromarray(photo_texture(args.size))
+    pixels = args.size * args.size
+
+    def verify(**options):
+        pbr_set = PBRSet(albedo, tile_rows=256)
+        pbr_set.verify_albedo(LIMIT_VALUES, "nonmetallic", **options)
+        return pbr_set
+
+    baseline = measure(verify, args.repeat)
+    overlay_bytes = np.asarray(verify().albedo_verified).nbytes
+    report("verify with overlay", baseline, pixels)
+
+    for encoding in ["packed", "rle"]:
+        report(f"verify with {encoding} mask", measure(lambda: verify(overlay=False, mask=encoding), args.repeat),
+               pixels, baseline)
+        pbr_set = verify(overlay=False, mask=encoding)
+        report(f"render {encoding} mask at 650", measure(lambda: pbr_set.render_verification(650), args.repeat),
+               pixels)
+        print(f"{encoding} mask {pbr_set.albedo_mask.nbytes() / 2 ** 10:.1f} KB, "
+              f"{overlay_bytes / pbr_set.albedo_mask.nbytes():.0f}x smaller than the overlay")
+
+
+def benchmark_stack(args):
+    # many same-size exports at a quarter of the benchmark size, at the default size the stack holds enough
+    # pixels for the auto engine to bake the exact color table once for all of them
+    size = args.size // 4
+    rng = np.random.default_rng(9)
+    images = [(Image.fromarray(photo_texture(size, seed=index)),
+               Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8)),
+               Image.fromarray(random_texture(size, seed=index))) for index in range(32)]
+    pixels = size * size * len(images)
+
+    def pbr_sets():
+        return [PBRSet(*textures, tile_rows=256, engine="auto") for textures in images]
+
+    for mode, is_compensating in [("nonmetallic", False), ("combined", True)]:
+        def one_by_one():
+            for pbr_set in pbr_sets():
+                pbr_set.correct_albedo(mode, LIMIT_VALUES, is_compensating)
+
+        baseline = measure(one_by_one, args.repeat)
+        report(f"correct {mode} one by one", baseline, pixels)
+        report(f"correct {mode} stacked",
+               measure(lambda: correct_stack(pbr_sets(), mode, LIMIT_VALUES, is_compensating), args.repeat), pixels,
+               baseline)
+
+    def verify_one_by_one():
+        for pbr_set in pbr_sets():
+            pbr_set.verify_albedo(LIMIT_VALUES, "combined", overlay=False)
+
+    baseline = measure(verify_one_by_one, args.repeat)
+    report("verify combined one by one", baseline, pixels)
+    report("verify combined stacked", measure(lambda: verify_stack(pbr_sets(), LIMIT_VALUES, "combined"), args.repeat),
+           pixels, baseline)
+
+
+def benchmark_backends(args):
+    # every backend against the pure NumPy reference, then the backend auto picks on this machine
+    image_data = calibration_data(args.size)
+    pixels = args.size * args.size
+    baselines = {}
+
+    for kernel in BACKENDS:
+        differences = check_backend(kernel, image_data=image_data)
+        calls = kernel_calls(BACKENDS[kernel], image_data)
+
+        for name in BACKEND_KERNELS:
+            seconds = measure(calls[name], args.repeat)
+            baselines.setdefault(name, seconds)
+            report(f"{name} {kernel}", seconds, pixels, baselines[name])
+            print(f"    max difference {differences[name]}")
+
+        assert max(differences.values()) <= BACKEND_TOLERANCE, f"{kernel} does not match the reference"
+
+    print(f"auto picks {calibrate_backends()}")
+
+
+BENCHMARKS = {
+    "kernels": benchmark_kernels,
+    "transfer": benchmark_transfer,
+    "mask": benchmark_mask,
+    "palette": benchmark_palette,
+    "lut": benchmark_lut,
+    "incremental": benchmark_incremental,
+    "preview": benchmark_preview,
+    "display": benchmark_display,
+    "textures": benchmark_textures,
+    "compensation": benchmark_compensation,
+    "threads": benchmark_threads,
+    "shared": benchmark_shared,
+    "pipeline": benchmark_pipeline,
+    "memory": benchmark_memory,
+    "manifest": benchmark_manifest,
+    "cache": benchmark_cache,
+    "verify": benchmark_verify,
+    "report": benchmark_report,
+    "masks": benchmark_masks,
+    "stack": benchmark_stack,
+    "backends": benchmark_backends,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Processing benchmarks on synthetic textures")
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)}, all by default")
+    parser.add_argument("-s", "--size", type=int, default=4096, help="texture width and height")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per measurement, the best is reported")
+    args = parser.parse_args()
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"== {name} ({args.size}x{args.size})")
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import argparse
+import os
+import sys
+
+from modules.Batch import find_texture_sets, run_batch, run_batch_shared, summarize
+from modules.Config import CFG, FINISH_STYLE_MODES
+from modules.Manifest import BuildManifest
+from modules.PBR import PBRSet
+from modules.Pipeline import run_pipeline, stage_report
+from modules.Report import run_report
+from modules.Watch import WatchDaemon
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Headless albedo correction and verification for texture sets")
+    parser.add_argument("task", choices=["correct", "verify", "report", "cube"])
+    parser.add_argument("paths", nargs="+",
+                        help="albedo textures or directories containing texture sets, the output file for cube")
+    parser.add_argument("-c", "--config", default="config.cfg")
+    parser.add_argument("-o", "--output", help="output directory, defaults to the albedo directory")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--finish-style", choices=list(FINISH_STYLE_MODES))
+    parser.add_argument("--l-min", type=int)
+    parser.add_argument("--l-max", type=int)
+    parser.add_argument("--b-limit", type=int)
+    parser.add_argument("--coefficient", type=float)
+    parser.add_argument("--no-compensation", action="store_true")
+    parser.add_argument("--cube-size", type=int, default=33, help="lattice size of exported .cube files")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="decode and encode in this process and pass pixels to workers through shared memory")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap decoding, correction and encoding of consecutive sets in one process")
+    parser.add_argument("--io-threads", type=int, help="decode and encode threads of the pipeline")
+    parser.add_argument("--memory-budget", type=int,
+                        help="megabytes the estimated peaks of parallel jobs may add up to, 0 for no limit")
+    parser.add_argument("--force", action="store_true",
+                        help="correct every set, even when the build manifest says its outputs are up to date")
+    parser.add_argument("--hash-inputs", action="store_true",
+                        help="compare input contents, so touched but unchanged textures are not corrected again")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process the sets of a directory whenever their textures change")
+    parser.add_argument("--poll", action="store_true", help="poll the watched directory instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between scans of the directory")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="seconds a changed texture has to stay unchanged before it is read")
+    parser.add_argument("--report-file", default="compliance_report.jsonl",
+                        help="compliance report, written as CSV for a .csv extension and JSON Lines otherwise")
+    parser.add_argument("--prepass-size", type=int, default=0,
+                        help="blocks per side of the report pre-pass, sets whose block bounds are within the limits "
+                             "skip the full check, 0 checks every texture at full size")
+
+    return parser.parse_args()
+
+
+def load_cfg(args):
+    cfg = CFG(args.config)
+
+    if args.finish_style is not None:
+        cfg.finish_style = args.finish_style
+        cfg.mode = FINISH_STYLE_MODES[args.finish_style]
+    if args.l_min is not None:
+        cfg.l_min = args.l_min
+    if args.l_max is not None:
+        cfg.l_max = args.l_max
+    if args.b_limit is not None:
+        cfg.b_limit = args.b_limit
+    if args.coefficient is not None:
+        cfg.compensation_coefficient = args.coefficient
+    if args.no_compensation:
+        cfg.is_compensating = False
+    if args.memory_budget is not None:
+        cfg.memory_budget_mb = args.memory_budget
+
+    return cfg
+
+
+def print_result(result):
+    name = result.texture_set.albedo_path
+
+    if result.error is not None:
+        print(f"FAILED     {name}: {result.error}")
+    elif result.task == "verify":
+        print(f"{result.percent_correct():>3}% correct {name} ({result.elapsed:.2f}s)")
+    else:
+        print(f"corrected  {name} ({result.elapsed:.2f}s)")
+
+
+def print_watch_result(result, latency):
+    print_result(result)
+    if latency is not None:
+        print(f"           output ready {latency:.2f}s after the last texture write")
+
+
+def watch(args, cfg):
+    daemon = WatchDaemon(args.paths[0], cfg, args.task, args.output, args.poll_interval, args.settle,
+                         not args.poll, print_watch_result)
+    print(f"Watching {args.paths[0]} ({type(daemon.watcher).__name__}), {cfg.finish_style} ({cfg.mode}), "
+          f"limits [{cfg.l_min}, {cfg.l_max}, {cfg.b_limit}]")
+
+    # sets changed while the daemon was not running are processed first
+    daemon.catch_up()
+    daemon.run()
+    return 0
+
+
+def print_record(record):
+    if record.get("error") is not None:
+        print(f"FAILED     {record['path']}: {record['error']}")
+    else:
+        print(f"{record['percent_correct']:>6.2f}% correct {record['path']} "
+              f"({record['checked']}, {record['elapsed']:.2f}s)")
+
+
+def export_cubes(cfg, path, size):
+    pbr_set = PBRSet(kernel=cfg.kernel, transfer=cfg.transfer)
+    limit_values = [cfg.l_min, cfg.l_max, cfg.b_limit]
+    cubes = [(path, cfg.mode)]
+
+    # combined mode blends both corrections through the metallic mask, so each gets its own file
+    if cfg.mode == "combined":
+        cubes = [(path, "nonmetallic"), (os.path.splitext(path)[0] + "_metallic.cube", "metallic")]
+
+    for cube_path, mode in cubes:
+        pbr_set.export_cube(cube_path, mode, limit_values, size)
+        print(f"Exported {cfg.finish_style} ({mode}) correction to {cube_path}")
+
+
+def main():
+    args = parse_arguments()
+    cfg = load_cfg(args)
+
+    if args.task == "cube":
+        export_cubes(cfg, args.paths[0], args.cube_size)
+        return 0
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    if args.watch:
+        if not os.path.isdir(args.paths[0]):
+            print(f"{args.paths[0]} is not a directory")
+            return 1
+        return watch(args, cfg)
+
+    texture_sets = find_texture_sets(args.paths, cfg.texture_patterns)
+    if not texture_sets:
+        print("No texture sets found")
+        return 1
+
+    manifest = None
+    if args.task == "correct":
+        manifest = BuildManifest(cfg, args.output, args.hash_inputs)
+        found = len(texture_sets)
+        if not args.force:
+            texture_sets = manifest.stale(texture_sets)
+
+        if not texture_sets:
+            manifest.save()
+            print(f"{found} texture sets, all up to date")
+            return 0
+        if len(texture_sets) < found:
+            print(f"{found - len(texture_sets)} of {found} texture sets up to date")
+
+    print(f"{len(texture_sets)} texture sets, {cfg.finish_style} ({cfg.mode}), "
+          f"limits [{cfg.l_min}, {cfg.l_max}, {cfg.b_limit}]")
+
+    if args.task == "report":
+        summary = run_report(texture_sets, cfg, args.report_file, args.workers, args.prepass_size, print_record)
+        print(f"{summary['sets']} texture sets in {summary['elapsed']:.2f}s: {summary['bounds']} passed the pre-pass, "
+              f"{summary['full']} checked at full size, {summary['failing']} not fully correct, "
+              f"{summary['errors']} failed, report written to {args.report_file}")
+        return 1 if summary["errors"] else 0
+
+    if args.pipeline:
+        results, elapsed, stages = run_pipeline(texture_sets, cfg, args.task, args.output,
+                                                args.io_threads or cfg.io_threads, callback=print_result)
+        print(summarize(results, elapsed))
+        print(stage_report(stages, elapsed))
+    else:
+        batch = run_batch_shared if args.shared_memory else run_batch
+        results, elapsed = batch(texture_sets, cfg, args.task, args.output, args.workers, print_result)
+        print(summarize(results, elapsed))
+
+    if manifest is not None:
+        for result in results:
+            if result.error is None:
+                manifest.record(result.texture_set)
+        manifest.save()
+
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
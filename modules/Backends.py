@@ -0,0 +1,317 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import warnings
+from functools import lru_cache
+
+import numexpr as ne
+import numpy as np
+
+from .ImageProcessing import GRAYSCALE_WEIGHTS, RANGE_KERNELS, SRGB_DECODE_LUT, SRGB_ENCODE_LUT, \
+    clamp_brightness_data, compensation_factors, correct_range_fused, correct_range_reference, for_row_bands, \
+    unclamp_brightness_data
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# the per-pixel kernels every backend provides, a backend that does not accelerate one uses the reference;
+# the sRGB transfer and the luminance are not backend kernels, they are selected with the transfer option
+BACKEND_KERNELS = ["correct_range", "clamp", "unclamp", "compensation"]
+
+# the fused kernel already differs from the reference by up to one level after rounding
+BACKEND_TOLERANCE = 1
+
+CALIBRATION_SIZE = 512
+CALIBRATION_REPEAT = 3
+
+# one measurement per machine and library versions, a lost file only means measuring again
+BACKEND_CACHE_PATH = os.path.join(tempfile.gettempdir(), "pbr_backends.json")
+
+# the exact transfer encodes with the curve, the lut transfer with SRGB_ENCODE_LUT
+NO_TABLE = np.empty(0)
+
+
+def jit(function):
+    # without numba the loops stay plain Python, far too slow to use, so the backend is only registered with numba
+    if numba is None:
+        return function
+
+    return numba.njit(nogil=True, cache=True)(function)
+
+
+@jit
+def encode_value(value, encode_table):
+    if encode_table.size == 0:
+        value /= 255
+        if value <= 0.0031308:
+            return value * 12.92 * 255
+        return (value ** (1.0 / 2.4) * 1.055 - 0.055) * 255
+
+    position = value * ((encode_table.size - 1) / 255)
+    index = min(int(position), encode_table.size - 2)
+    return encode_table[index] + (position - index) * (encode_table[index + 1] - encode_table[index])
+
+
+@jit
+def correct_pixels(pixels, l_min, l_max, decode_table, encode_table, out):
+    # the steps of correct_range per pixel, in double precision like the reference
+    for index in range(pixels.shape[0]):
+        luminance = 0.299 * decode_table[max(pixels[index, 0], 1)] + \
+            0.587 * decode_table[max(pixels[index, 1], 1)] + 0.114 * decode_table[max(pixels[index, 2], 1)]
+        corrected = min(max(luminance, l_min), l_max)
+        lightening = max(corrected - luminance, 0.0)
+        darkening = max(luminance - corrected, 0.0)
+        denominator = max(luminance, 1e-12)
+
+        for channel in range(3):
+            linear = decode_table[max(pixels[index, channel], 1)]
+            value = min(max(linear + lightening * (linear / denominator) - darkening, 0.0), 255.0)
+            out[index, channel] = int(encode_value(value, encode_table))
+
+
+@jit
+def clamp_pixels(pixels, brightness_limit, out):
+    for index in range(pixels.shape[0]):
+        value = np.float32(pixels[index].max())
+        factor = int(min(max(value ** (value / brightness_limit), np.float32(0)), np.float32(255)))
+
+        for channel in range(pixels.shape[1]):
+            out[index, channel] = int(pixels[index, channel]) * factor // 255
+
+
+@jit
+def unclamp_pixels(pixels, scale, out):
+    for index in range(pixels.shape[0]):
+        offset = int((np.float32(255) - np.float32(pixels[index].max())) / scale)
+
+        for channel in range(pixels.shape[1]):
+            out[index, channel] = min(int(pixels[index, channel]) + offset, 255)
+
+
+@jit
+def compensation_pixels(albedo, corrected, weights, lightening, darkening):
+    # every product and sum is an integer below 2^24, exact in float32 like the matrix product of the reference
+    for index in range(albedo.shape[0]):
+        light = np.float32(0)
+        dark = np.float32(0)
+
+        for channel in range(3):
+            difference = np.float32(corrected[index, channel]) - np.float32(albedo[index, channel])
+            if difference > 0:
+                light += difference * weights[channel]
+            else:
+                dark += difference * weights[channel]
+
+        lightening[index] = int((light + np.float32(0x8000)) / np.float32(0x10000))
+        darkening[index] = int((np.float32(0x8000) - dark) / np.float32(0x10000))
+
+
+def pixel_rows(image_data):
+    # any leading shape as one row per pixel, apply_by_mask hands over gathered (N, 3) pixels
+    return np.ascontiguousarray(image_data).reshape(-1, image_data.shape[-1])
+
+
+def pixel_function(kernel, image_data, *args, out=None):
+    if out is None:
+        out = np.empty(image_data.shape, dtype=np.uint8)
+
+    result = out if out.flags.c_contiguous else np.empty(out.shape, dtype=np.uint8)
+    kernel(pixel_rows(image_data), *args, result.reshape(-1, result.shape[-1]))
+
+    if result is not out:
+        out[...] = result
+    return out
+
+
+def correct_range_numba(image_data, limit_values, out=None, transfer="exact"):
+    encode_table = SRGB_ENCODE_LUT if transfer == "lut" else NO_TABLE
+
+    # 8-bit input only has 256 values, the decode table is exact for every transfer
+    return pixel_function(correct_pixels, image_data, float(limit_values[0]), float(limit_values[1]),
+                          SRGB_DECODE_LUT, encode_table, out=out)
+
+
+def clamp_brightness_numba(image_data, brightness_limit=52):
+    return pixel_function(clamp_pixels, image_data, np.float32(brightness_limit))
+
+
+def unclamp_brightness_numba(image_data, brightness_limit):
+    return pixel_function(unclamp_pixels, image_data, np.float32(255 / brightness_limit))
+
+
+def compensation_factors_numba(albedo_data, corrected_data, tile_rows=256, workers=1):
+    lightening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8)
+    darkening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8)
+
+    def factors(rows):
+        compensation_pixels(pixel_rows(albedo_data[rows, :, :3]), pixel_rows(corrected_data[rows, :, :3]),
+                            GRAYSCALE_WEIGHTS, lightening_data[rows].reshape(-1), darkening_data[rows].reshape(-1))
+
+    for_row_bands(factors, albedo_data.shape[0], tile_rows, workers)
+
+    return lightening_data, darkening_data
+
+
+# backends are selected with the kernel option, the reference is NumPy and the pure NumPy reference with the
+# numpy transfer, the fused kernel evaluates the whole range correction in numexpr
+BACKENDS = {
+    "reference": {
+        "correct_range": correct_range_reference,
+        "clamp": clamp_brightness_data,
+        "unclamp": unclamp_brightness_data,
+        "compensation": compensation_factors,
+    },
+}
+BACKENDS["fused"] = dict(BACKENDS["reference"], correct_range=correct_range_fused)
+
+if numba is not None:
+    BACKENDS["numba"] = {
+        "correct_range": correct_range_numba,
+        "clamp": clamp_brightness_numba,
+        "unclamp": unclamp_brightness_numba,
+        "compensation": compensation_factors_numba,
+    }
+    # correct_range_tiled and the stack engine look range kernels up by name
+    RANGE_KERNELS["numba"] = correct_range_numba
+
+KERNEL_NAMES = list(BACKENDS) + ["auto"]
+
+
+def backend_kernel(kernel, name):
+    return BACKENDS[kernel][name]
+
+
+def calibration_data(size=CALIBRATION_SIZE):
+    rng = np.random.default_rng(0)
+    image_data = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    # black, white and primaries reach both luminance limits and both branches of the transfer curves
+    image_data[0, :8] = [[0, 0, 0], [255, 255, 255], [255, 0, 0], [0, 255, 0], [0, 0, 255], [1, 1, 1],
+                         [254, 254, 254], [10, 10, 10]]
+
+    return image_data
+
+
+def kernel_calls(kernels, image_data, transfer="exact"):
+    limit_values = [8, 235, 52]
+
+    return {
+        "correct_range": lambda: kernels["correct_range"](image_data, limit_values, transfer=transfer),
+        "clamp": lambda: kernels["clamp"](image_data, limit_values[2]),
+        "unclamp": lambda: kernels["unclamp"](image_data, limit_values[2]),
+        "compensation": lambda: kernels["compensation"](image_data, image_data[::-1]),
+    }
+
+
+def kernel_difference(result, expected):
+    results = result if isinstance(result, tuple) else (result,)
+    expected = expected if isinstance(expected, tuple) else (expected,)
+
+    if [part.shape for part in results] != [part.shape for part in expected]:
+        return 256
+
+    return max(int(np.abs(part.astype(np.int16) - reference).max()) for part, reference in zip(results, expected))
+
+
+def check_backend(kernel, transfer="exact", image_data=None):
+    # the largest difference to the reference per kernel, the pure NumPy reference for the exact transfer
+    image_data = calibration_data(64) if image_data is None else image_data
+    reference_transfer = "numpy" if transfer == "exact" else transfer
+    expected = {name: call() for name, call in kernel_calls(BACKENDS["reference"], image_data,
+                                                            reference_transfer).items()}
+
+    return {name: kernel_difference(call(), expected[name])
+            for name, call in kernel_calls(BACKENDS[kernel], image_data, transfer).items()}
+
+
+def measure_backend(kernel, transfer="exact", image_data=None):
+    # seconds per kernel, raises for a backend that does not match the reference
+    image_data = calibration_data() if image_data is None else image_data
+
+    # the check also compiles the numba kernels, compilation is not part of the measurement
+    differences = check_backend(kernel, transfer)
+    if max(differences.values()) > BACKEND_TOLERANCE:
+        mismatched = ", ".join(f"{name} by {difference}" for name, difference in differences.items()
+                               if difference > BACKEND_TOLERANCE)
+        raise ValueError(f"differs from the reference in {mismatched} levels, expected at most {BACKEND_TOLERANCE}")
+
+    timings = {}
+    for name, call in kernel_calls(BACKENDS[kernel], image_data, transfer).items():
+        best = float("inf")
+        for _ in range(CALIBRATION_REPEAT):
+            start = time.perf_counter()
+            call()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+
+    return timings
+
+
+def calibration_key(transfer):
+    versions = [f"numpy {np.__version__}", f"numexpr {ne.__version__}",
+                f"numba {numba.__version__}" if numba is not None else "no numba"]
+
+    return ", ".join([platform.machine(), f"{os.cpu_count()} cores", transfer] + versions)
+
+
+def load_calibration(path):
+    try:
+        with open(path) as calibration_file:
+            return json.load(calibration_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_calibration(path, calibration):
+    temporary_path = path + f".{os.getpid()}.tmp"
+
+    try:
+        with open(temporary_path, 'w') as calibration_file:
+            json.dump(calibration, calibration_file, indent=1)
+        os.replace(temporary_path, path)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def calibrate_backends(transfer="exact", path=BACKEND_CACHE_PATH):
+    # the backend with the shortest total time over all kernels, among those that match the reference;
+    # worker processes and later runs read the choice back instead of measuring again
+    key = calibration_key(transfer)
+    calibration = load_calibration(path)
+
+    if calibration.get(key, {}).get("backend") in BACKENDS:
+        return calibration[key]["backend"]
+
+    image_data = calibration_data()
+    seconds = {}
+    rejected = {}
+    for kernel in BACKENDS:
+        # a backend that fails or does not match the reference is left out, the reason is kept with the choice
+        try:
+            seconds[kernel] = sum(measure_backend(kernel, transfer, image_data).values())
+        except Exception as e:
+            rejected[kernel] = f"{type(e).__name__}: {e}"
+            warnings.warn(f"{kernel} kernel rejected for the {transfer} transfer, {rejected[kernel]}")
+
+    backend = min(seconds, key=seconds.get) if seconds else "reference"
+    calibration[key] = {"backend": backend, "seconds": seconds, "rejected": rejected}
+    save_calibration(path, calibration)
+
+    return backend
+
+
+def resolve_kernel(kernel, transfer="exact"):
+    if kernel == "auto":
+        return calibrate_backends(transfer)
+
+    if kernel not in BACKENDS:
+        if kernel == "numba":
+            raise ValueError("the numba kernel needs numba to be installed, use auto to fall back to the fastest "
+                             "available kernel")
+        raise ValueError(f"unknown kernel {kernel}, expected one of {', '.join(KERNEL_NAMES)}")
+
+    return kernel
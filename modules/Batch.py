@@ -0,0 +1,336 @@
+import copy
+import os
+import queue
+import re
+import time
+from collections import deque
+from multiprocessing import Pool
+
+from PIL import Image
+
+from .Cache import ResultCache
+from .Config import TEXTURE_PATTERNS
+from .Memory import MemoryScheduler, calibrate_memory_model, estimate_peak_memory, texture_pixels
+from .PBR import PBRSet
+from .Shared import SharedExecutor
+from .Textures import TextureStore
+
+IMAGE_EXTENSIONS = (".tga", ".png", ".jpg", ".jpeg", ".jp2", ".bmp")
+
+
+class TextureSet:
+    def __init__(self, albedo_path, metallic_path=None, roughness_path=None):
+        self.albedo_path = albedo_path
+        self.metallic_path = metallic_path
+        self.roughness_path = roughness_path
+
+    def name(self):
+        return os.path.basename(self.albedo_path).split(".")[0]
+
+
+class BatchResult:
+    def __init__(self, texture_set, task):
+        self.texture_set = texture_set
+        self.task = task
+        self.pixels = 0
+        self.mismatched_pixels = 0
+        self.elapsed = 0.0
+        self.error = None
+        # lookups of the on-disk result cache, answered and missed
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def percent_correct(self):
+        if not self.pixels:
+            return 0
+        return 100 - round(self.mismatched_pixels / self.pixels * 100)
+
+
+def compile_patterns(patterns=None):
+    # "*" becomes the captured set name, matching ignores case like the file systems the textures come from
+    return {texture_type: [re.compile(re.escape(pattern).replace(r"\*", "(.+)"), re.IGNORECASE)
+                           for pattern in texture_patterns]
+            for texture_type, texture_patterns in (patterns or TEXTURE_PATTERNS).items()}
+
+
+def split_texture_name(path, patterns=None):
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    for texture_type, expressions in (patterns or compile_patterns()).items():
+        for expression in expressions:
+            match = expression.fullmatch(stem)
+            if match is not None:
+                return match.group(1), texture_type
+
+    return stem, None
+
+
+def group_textures(directory, filenames, patterns=None):
+    groups = {}
+    patterns = patterns or compile_patterns()
+
+    for filename in sorted(filenames):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+
+        base_name, texture_type = split_texture_name(filename, patterns)
+        if texture_type is not None:
+            groups.setdefault(base_name, {}).setdefault(texture_type, os.path.join(directory, filename))
+
+    return groups
+
+
+def find_texture_sets(paths, patterns=None):
+    texture_sets = []
+    patterns = compile_patterns(patterns)
+
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                for textures in group_textures(directory, filenames, patterns).values():
+                    if "albedo" in textures:
+                        texture_sets.append(TextureSet(textures["albedo"], textures.get("metallic"),
+                                                       textures.get("roughness")))
+
+        elif os.path.isfile(path):
+            directory = os.path.dirname(path)
+            base_name, _ = split_texture_name(path, patterns)
+            textures = group_textures(directory, os.listdir(directory or "."), patterns).get(base_name, {})
+            texture_sets.append(TextureSet(path, textures.get("metallic"), textures.get("roughness")))
+
+    return texture_sets
+
+
+def texture_images(texture_set, cfg, store):
+    albedo = store.open(texture_set.albedo_path)
+    metallic = None
+    roughness = None
+
+    if cfg.mode == "combined":
+        if texture_set.metallic_path is None:
+            raise ValueError("metallic texture is required in combined mode")
+        metallic = store.resize(store.open(texture_set.metallic_path), albedo.size)
+
+    if cfg.is_compensating and cfg.mode in ["metallic", "combined"]:
+        if texture_set.roughness_path is None:
+            raise ValueError("roughness texture is required for compensation")
+        roughness = store.resize(store.open(texture_set.roughness_path, "RGB"), albedo.size)
+
+    return albedo, metallic, roughness
+
+
+def processing_options(cfg):
+    return dict(tile_rows=cfg.tile_rows, kernel=cfg.kernel, transfer=cfg.transfer, engine=cfg.engine,
+                lut_size=cfg.lut_size, workers=cfg.threads)
+
+
+def load_pbr_set(texture_set, cfg, cache=None, store=None):
+    store = store or TextureStore(cfg.texture_cache_directory or None)
+
+    return PBRSet(*texture_images(texture_set, cfg, store), cache=cache, **processing_options(cfg))
+
+
+def save_pbr_set(pbr_set, texture_set, output_dir=None):
+    roughness_filename = None
+    if texture_set.roughness_path is not None:
+        roughness_filename = os.path.basename(texture_set.roughness_path).split(".")[0]
+
+    pbr_set.save(output_dir or os.path.dirname(texture_set.albedo_path) or ".", texture_set.name(), roughness_filename)
+
+
+def process_texture_set(texture_set, cfg, task="correct", output_dir=None):
+    result = BatchResult(texture_set, task)
+    start = time.perf_counter()
+    cache = None
+
+    try:
+        # worker processes do not share memory, so batches only use the on-disk cache tier
+        cache = ResultCache(0, cfg.cache_directory) if cfg.cache_directory else None
+        pbr_set = load_pbr_set(texture_set, cfg, cache)
+        limit_values = [cfg.l_min, cfg.l_max, cfg.b_limit]
+        result.pixels = pbr_set.size()
+
+        if task == "correct":
+            pbr_set.correct_albedo(cfg.mode, limit_values, cfg.is_compensating, cfg.compensation_coefficient)
+            save_pbr_set(pbr_set, texture_set, output_dir)
+
+        elif task == "verify":
+            result.mismatched_pixels = int(pbr_set.verify_albedo(limit_values, cfg.mode, overlay=False))
+
+    except Exception as e:
+        result.error = str(e)
+
+    if cache is not None:
+        stats = cache.stats()
+        result.cache_hits = stats["hits"] + stats["disk_hits"]
+        result.cache_misses = stats["misses"]
+
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _process_job(job):
+    return process_texture_set(*job)
+
+
+def run_batch(texture_sets, cfg, task="correct", output_dir=None, workers=None, callback=None):
+    results = []
+    start = time.perf_counter()
+
+    if workers != 1 and len(texture_sets) > 1:
+        # the process pool already occupies the cores, row band threads on top would only contend
+        cfg = copy.copy(cfg)
+        cfg.threads = 1
+
+    jobs = [(texture_set, cfg, task, output_dir) for texture_set in texture_sets]
+
+    if cfg.memory_budget_mb > 0 and workers != 1 and len(jobs) > 1:
+        results = run_scheduled_jobs(jobs, cfg, workers or os.cpu_count() or 1, callback)
+
+    elif workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            results.append(_process_job(job))
+            if callback is not None:
+                callback(results[-1])
+    else:
+        with Pool(workers) as pool:
+            for result in pool.imap_unordered(_process_job, jobs):
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+
+    return results, time.perf_counter() - start
+
+
+def job_estimates(jobs, cfg):
+    options = tuple(sorted(processing_options(cfg).items()))
+    model = calibrate_memory_model(options)
+    estimates = []
+
+    for job in jobs:
+        try:
+            pixels = texture_pixels(job[0].albedo_path)
+        except Exception:
+            pixels = 0
+
+        estimates.append(estimate_peak_memory(pixels, job[2], cfg.mode, cfg.is_compensating, model))
+
+    return estimates
+
+
+def run_scheduled_jobs(jobs, cfg, workers, callback=None):
+    # jobs are only started while their estimated peaks fit the budget together
+    scheduler = MemoryScheduler(cfg.memory_budget_mb * 1024 * 1024, workers)
+    pending = list(zip(job_estimates(jobs, cfg), range(len(jobs))))
+    completed = queue.Queue()
+    results = []
+
+    with Pool(workers) as pool:
+        while pending or scheduler.running:
+            admitted = scheduler.admit(pending)
+
+            while admitted is not None:
+                estimate, index = admitted
+                scheduler.start(index, estimate)
+
+                def done(result, index=index):
+                    completed.put((index, result))
+
+                def failed(error, index=index):
+                    result = BatchResult(jobs[index][0], jobs[index][2])
+                    result.error = str(error)
+                    completed.put((index, result))
+
+                pool.apply_async(_process_job, (jobs[index],), callback=done, error_callback=failed)
+                admitted = scheduler.admit(pending)
+
+            index, result = completed.get()
+            scheduler.finish(index)
+            results.append(result)
+            if callback is not None:
+                callback(result)
+
+    return results
+
+
+def finish_shared_job(executor, result, job, output_dir=None):
+    try:
+        outputs, summary = executor.wait(job)
+
+        if result.task == "correct":
+            pbr_set = PBRSet()
+            pbr_set.albedo_corrected = Image.fromarray(outputs["albedo"])
+            if summary["roughness_corrected"]:
+                pbr_set.roughness_corrected = Image.fromarray(outputs["roughness"])
+            save_pbr_set(pbr_set, result.texture_set, output_dir)
+
+        elif result.task == "verify":
+            result.mismatched_pixels = summary["mismatched_pixels"]
+
+    except Exception as e:
+        result.error = str(e)
+
+    finally:
+        executor.release(job)
+
+
+def run_batch_shared(texture_sets, cfg, task="correct", output_dir=None, workers=None, callback=None):
+    # textures are decoded and encoded here, workers only read and write shared memory blocks
+    results = []
+    start = time.perf_counter()
+    store = TextureStore(cfg.texture_cache_directory or None)
+    limit_values = [cfg.l_min, cfg.l_max, cfg.b_limit]
+    options = dict(processing_options(cfg), workers=1)
+
+    with SharedExecutor(workers, **options) as executor:
+        pending = deque()
+
+        def finish(result, job, started):
+            if job is not None:
+                finish_shared_job(executor, result, job, output_dir)
+
+            result.elapsed = time.perf_counter() - started
+            results.append(result)
+            if callback is not None:
+                callback(result)
+
+        for texture_set in texture_sets:
+            result = BatchResult(texture_set, task)
+            started = time.perf_counter()
+            job = None
+
+            try:
+                albedo, metallic, roughness = texture_images(texture_set, cfg, store)
+                result.pixels = albedo.width * albedo.height
+                job = executor.submit(task, albedo, metallic, roughness, cfg.mode, limit_values,
+                                      cfg.is_compensating, cfg.compensation_coefficient, overlay=False)
+            except Exception as e:
+                result.error = str(e)
+
+            pending.append((result, job, started))
+
+            # two jobs per worker keep the pool busy while bounding the shared memory in use
+            if len(pending) >= executor.processes * 2:
+                finish(*pending.popleft())
+
+        while pending:
+            finish(*pending.popleft())
+
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    processed = [result for result in results if result.error is None]
+    megapixels = sum(result.pixels for result in processed) / 1e6
+    elapsed = max(elapsed, 1e-9)
+
+    summary = (f"{len(processed)}/{len(results)} texture sets in {elapsed:.2f}s: "
+               f"{len(processed) / elapsed:.2f} textures/sec, {megapixels / elapsed:.2f} megapixels/sec")
+
+    # only batches with a cache directory look results up
+    hits = sum(result.cache_hits for result in results)
+    lookups = hits + sum(result.cache_misses for result in results)
+    if lookups:
+        summary += f", {hits}/{lookups} results from the cache"
+
+    return summary
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResultCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # digests of source images by id, dropped when the image is garbage collected
+        self.digests = {}
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def image_digest(self, image):
+        if image is None:
+            return "none"
+
+        digest = self.digests.get(id(image))
+        if digest is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(f"{image.mode} {image.size}".encode())
+            hasher.update(image.tobytes())
+            digest = hasher.hexdigest()
+            self.digests[id(image)] = digest
+            weakref.finalize(image, self.digests.pop, id(image), None)
+
+        return digest
+
+    def key(self, images, *parameters):
+        hasher = hashlib.blake2b(digest_size=20)
+
+        for image in images:
+            hasher.update(self.image_digest(image).encode())
+        hasher.update(repr(parameters).encode())
+
+        return hasher.hexdigest()
+
+    def get(self, key):
+        result = self.entries.get(key)
+
+        if result is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+        result = self.load(key)
+
+        if result is not None:
+            self.disk_hits += 1
+            self.remember(key, result)
+            return result
+
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self.remember(key, result)
+        self.store(key, result)
+
+    def remember(self, key, result):
+        if key in self.entries:
+            self.size -= result_size(self.entries.pop(key))
+
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = result
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= result_size(evicted)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        if not self.directory or not os.path.isfile(self.path(key)):
+            return None
+
+        try:
+            with np.load(self.path(key)) as stored:
+                return {name: stored[name] for name in stored.files}
+        except Exception:
+            return None
+
+    def store(self, key, result):
+        if not self.directory:
+            return
+
+        # write to a temporary file first so parallel workers never read a partial entry
+        temporary_path = self.path(key) + f".{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as cache_file:
+            np.savez(cache_file, **{name: value for name, value in result.items() if value is not None})
+        os.replace(temporary_path, self.path(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        requests = self.hits + self.disk_hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / requests if requests else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+
+def result_size(result):
+    return sum(np.asarray(value).nbytes for value in result.values() if value is not None)
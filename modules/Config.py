@@ -1,4 +1,40 @@
 import configparser
+import warnings
+
+from .Backends import KERNEL_NAMES
+from .ImageProcessing import TRANSFER_FUNCTIONS
+from .PBR import ENGINES
+
+FINISH_STYLE_MODES = {
+    "Gunsmith": "combined",
+    "Patina": "metallic",
+    "Anodized Multicolored": "metallic",
+    "Custom Paint Job": "nonmetallic",
+    "Spray-Paint": "nonmetallic",
+    "Hydrographic": "nonmetallic",
+    "Anodized": "nonmetallic",
+    "Anodized Airbrushed": "nonmetallic",
+}
+
+# "*" stands for the set name, the first matching pattern decides the texture type
+TEXTURE_PATTERNS = {
+    "albedo": ["*_albedo", "*_basecolor", "*_base_color", "*_color", "*_diffuse"],
+    "metallic": ["*_metallic", "*_metalness", "*_metal"],
+    "roughness": ["*_roughness", "*_rough"],
+}
+
+
+def read_option(config, section, key, default, read="get", choices=None):
+    # every option falls back to its own default, a malformed value does not take the ones after it along
+    try:
+        value = getattr(config, read)(section, key, fallback=default)
+        if choices is not None and value not in choices:
+            raise ValueError(f"unknown value {value}, expected one of {', '.join(choices)}")
+        return value
+
+    except (ValueError, configparser.Error) as e:
+        warnings.warn(f"{section} {key} falls back to {default}: {e}")
+        return default
 
 
 class CFG:
@@ -15,6 +51,20 @@ class CFG:
         self.l_min = 8
         self.l_max = 235
         self.b_limit = 70
+        self.tile_rows = 0
+        self.kernel = "reference"
+        self.transfer = "exact"
+        self.engine = "auto"
+        self.lut_size = 256
+        self.cache_size_mb = 512
+        self.cache_directory = ""
+        # full-size intermediates are opt-in, the preview proxies always keep theirs
+        self.incremental = False
+        self.texture_cache_directory = ""
+        self.threads = 1
+        self.io_threads = 2
+        self.memory_budget_mb = 0
+        self.texture_patterns = {texture_type: list(patterns) for texture_type, patterns in TEXTURE_PATTERNS.items()}
 
         try:
             with open(self.file, 'r') as configfile:
@@ -32,6 +82,25 @@ class CFG:
         except Exception:
             pass
 
+        # the processing sections are optional
+        self.tile_rows = read_option(config, 'PROCESSING', 'tile_rows', self.tile_rows, "getint")
+        self.kernel = read_option(config, 'PROCESSING', 'kernel', self.kernel, choices=KERNEL_NAMES)
+        self.transfer = read_option(config, 'PROCESSING', 'transfer', self.transfer, choices=list(TRANSFER_FUNCTIONS))
+        self.engine = read_option(config, 'PROCESSING', 'engine', self.engine, choices=ENGINES)
+        self.lut_size = read_option(config, 'PROCESSING', 'lut_size', self.lut_size, "getint")
+        self.cache_size_mb = read_option(config, 'PROCESSING', 'cache_size_mb', self.cache_size_mb, "getint")
+        self.cache_directory = read_option(config, 'PROCESSING', 'cache_directory', self.cache_directory)
+        self.incremental = read_option(config, 'PROCESSING', 'incremental', self.incremental, "getboolean")
+        self.texture_cache_directory = read_option(config, 'PROCESSING', 'texture_cache_directory',
+                                                   self.texture_cache_directory)
+        self.threads = read_option(config, 'PROCESSING', 'threads', self.threads, "getint")
+        self.io_threads = read_option(config, 'PROCESSING', 'io_threads', self.io_threads, "getint")
+        self.memory_budget_mb = read_option(config, 'PROCESSING', 'memory_budget_mb', self.memory_budget_mb, "getint")
+
+        for texture_type, patterns in self.texture_patterns.items():
+            patterns = read_option(config, 'DISCOVERY', texture_type, ", ".join(patterns)).split(",")
+            self.texture_patterns[texture_type] = [pattern.strip() for pattern in patterns if pattern.strip()]
+
     def write(self):
         config = configparser.ConfigParser()
 
@@ -45,6 +114,24 @@ class CFG:
             'brightness_limit': self.b_limit,
         }
 
+        config['PROCESSING'] = {
+            'tile_rows': self.tile_rows,
+            'kernel': self.kernel,
+            'transfer': self.transfer,
+            'engine': self.engine,
+            'lut_size': self.lut_size,
+            'cache_size_mb': self.cache_size_mb,
+            'cache_directory': self.cache_directory,
+            'incremental': self.incremental,
+            'texture_cache_directory': self.texture_cache_directory,
+            'threads': self.threads,
+            'io_threads': self.io_threads,
+            'memory_budget_mb': self.memory_budget_mb,
+        }
+
+        config['DISCOVERY'] = {texture_type: ", ".join(patterns)
+                               for texture_type, patterns in self.texture_patterns.items()}
+
         config['APPLICATION'] = {
             'version': self.version
         }
@@ -0,0 +1,75 @@
+import weakref
+
+from PIL import Image, ImageChops
+
+VIEW_SIZE = 650
+ICON_SIZE = 64
+
+
+def downsample(image, size):
+    if image.mode not in ["L", "RGB", "RGBA"]:
+        image = image.convert("RGBA")
+
+    # thumbnail reduces by whole factors first and only resamples the last step
+    image = image.copy()
+    image.thumbnail((size, size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+    return image
+
+
+def opaque(image, remove_alpha=True):
+    if remove_alpha:
+        return image.convert("RGB").convert("RGBA")
+
+    return image.convert("RGBA")
+
+
+class DisplayCache:
+    def __init__(self, view_size=VIEW_SIZE, icon_size=ICON_SIZE):
+        self.view_size = view_size
+        self.icon_size = icon_size
+        # display versions by the id of their source image, dropped when the source is garbage collected
+        self.entries = {}
+
+    def remember(self, image, key, create):
+        entries = self.entries.get(id(image))
+
+        if entries is None:
+            entries = self.entries[id(image)] = {}
+            weakref.finalize(image, self.forget, id(image))
+
+        if key not in entries:
+            entries[key] = create()
+
+        return entries[key]
+
+    def forget(self, image_id):
+        self.entries.pop(image_id, None)
+
+        # composites are stored under the image they were multiplied onto
+        for entries in self.entries.values():
+            for key in [key for key in entries if image_id in key[1:]]:
+                del entries[key]
+
+    def proxy(self, image, size):
+        return self.remember(image, ("proxy", size), lambda: downsample(image, size))
+
+    def view(self, image, size=None, remove_alpha=True):
+        size = size or self.view_size
+        return self.remember(image, ("view", size, remove_alpha), lambda: opaque(self.proxy(image, size), remove_alpha))
+
+    def icon(self, image):
+        return self.remember(image, ("icon", self.icon_size), lambda: opaque(self.proxy(image, self.icon_size)))
+
+    def ambient_occlusion(self, image, ao_image, size=None):
+        size = size or self.view_size
+
+        def multiply():
+            proxy = self.proxy(image, size).convert("RGB")
+            ao_proxy = self.proxy(ao_image, size).convert("RGB")
+            if ao_proxy.size != proxy.size:
+                ao_proxy = ao_proxy.resize(proxy.size, Image.Resampling.BILINEAR)
+
+            return opaque(ImageChops.multiply(proxy, ao_proxy))
+
+        return self.remember(image, ("ao", id(ao_image), size), multiply)
@@ -5,16 +5,22 @@ from PyQt6 import uic
 from PyQt6.QtWidgets import QMainWindow, QPushButton, QLineEdit, QFileDialog, QToolButton, QWidget, QVBoxLayout, QLabel, \
     QComboBox, QCheckBox, QSpinBox, QDoubleSpinBox, QGroupBox
 from PyQt6.QtGui import QFontDatabase, QIcon, QPixmap
-from PyQt6.QtCore import Qt, QCoreApplication, QThread, pyqtSignal
+from PyQt6.QtCore import Qt, QCoreApplication, QThread, QTimer, pyqtSignal
 
-from PIL import Image, ImageChops
+from PIL import Image
 
 import ctypes
 from ctypes.wintypes import DWORD, ULONG
 from ctypes import windll, c_bool, c_int, POINTER, Structure
 
+from modules.Cache import ResultCache
 from modules.Config import CFG
+from modules.Display import DisplayCache
 from modules.PBR import PBRSet
+from modules.Textures import TextureStore
+
+PREVIEW_SIZE = 650
+PREVIEW_DELAY = 150
 
 
 class ACCENTPOLICY(Structure):
@@ -54,22 +60,46 @@ class ProcessingThread(QThread):
     albedo_verified = None
     mismatched_pixels = 0
     limit_values = None
+    tile_rows = 0
+    kernel = "reference"
+    transfer = "exact"
+    engine = "auto"
+    lut_size = 256
+    cache = None
+    incremental = False
+    threads = 1
+    pbr_set = None
 
     def run(self):
         self.signal.emit("Processing...")
 
-        pbr_set = PBRSet(self.albedo, self.metallic, self.roughness)
+        # an incremental set keeps its intermediates, so it is reused while the same textures are loaded
+        if not self.incremental or not self.has_same_textures():
+            self.pbr_set = PBRSet(self.albedo, self.metallic, self.roughness, tile_rows=self.tile_rows,
+                                  kernel=self.kernel, transfer=self.transfer, engine=self.engine,
+                                  lut_size=self.lut_size, cache=self.cache, incremental=self.incremental,
+                                  workers=self.threads)
+        pbr_set = self.pbr_set
+
         if self.type == "correcting":
             pbr_set.correct_albedo(self.mode, self.limit_values, self.is_compensating, self.compensation_coefficient)
             self.albedo_corrected = pbr_set.albedo_corrected
             self.roughness_corrected = pbr_set.roughness_corrected
 
         elif self.type == "verifying":
-            self.mismatched_pixels = pbr_set.verify_albedo(self.limit_values, self.mode)
-            self.albedo_verified = pbr_set.albedo_verified
+            # only the compact mask is kept at full size, the overlay is rendered at the size it is viewed at
+            self.mismatched_pixels = pbr_set.verify_albedo(self.limit_values, self.mode, overlay=False, mask="rle")
+            self.albedo_verified = pbr_set.render_verification(PREVIEW_SIZE)
 
         self.signal.emit("Done")
 
+    def has_same_textures(self):
+        if self.pbr_set is None:
+            return False
+
+        textures = (self.albedo, self.metallic, self.roughness)
+        return all(texture is source for texture, source in zip(textures, self.pbr_set.source_images))
+
 
 class GUI(QMainWindow):
     def __init__(self):
@@ -82,6 +112,18 @@ class GUI(QMainWindow):
         self.metallic_image = None
         self.roughness_image = None
         self.ao_image = None
+        self.display_cache = DisplayCache(PREVIEW_SIZE)
+        self.preview_set = None
+        self.preview_type = "correcting"
+        self.corrected_parameters = None
+        self.is_saving = False
+
+        # parameter changes restart the timer, so a spin box held down only previews once it settles
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.update_preview)
+
         self.load_cfg()
         self.setup_ui_form()
         app_icon = QIcon("UI/icons/app_icon.png")
@@ -90,6 +132,14 @@ class GUI(QMainWindow):
         self.show()
 
         self.processing_thread = ProcessingThread()
+        self.processing_thread.tile_rows = self.tile_rows
+        self.processing_thread.kernel = self.kernel
+        self.processing_thread.transfer = self.transfer
+        self.processing_thread.engine = self.engine
+        self.processing_thread.lut_size = self.lut_size
+        self.processing_thread.cache = self.result_cache
+        self.processing_thread.incremental = self.incremental
+        self.processing_thread.threads = self.threads
         self.processing_thread.signal.connect(self.handle_processing_signal)
 
     def load_cfg(self):
@@ -101,6 +151,15 @@ class GUI(QMainWindow):
         self.b_limit = cfg.b_limit
         self.finish_style = cfg.finish_style
         self.mode = cfg.mode
+        self.tile_rows = cfg.tile_rows
+        self.kernel = cfg.kernel
+        self.transfer = cfg.transfer
+        self.engine = cfg.engine
+        self.lut_size = cfg.lut_size
+        self.incremental = cfg.incremental
+        self.threads = cfg.threads
+        self.result_cache = ResultCache(cfg.cache_size_mb * 1024 * 1024, cfg.cache_directory or None)
+        self.texture_store = TextureStore(cfg.texture_cache_directory or None)
 
     def write_cfg(self):
         cfg = CFG("config.cfg")
@@ -124,6 +183,7 @@ class GUI(QMainWindow):
         if message == "Done":
             self.pbr_set = PBRSet(self.processing_thread.albedo, self.processing_thread.metallic)
             if self.processing_thread.type == "correcting":
+                self.corrected_parameters = self.processing_parameters()
                 self.status_label.setText("Albedo texture was corrected successfully")
                 self.status_label.setStyleSheet("color: rgba(168, 168, 168, 0.582);")
 
@@ -136,6 +196,10 @@ class GUI(QMainWindow):
 
                 self.toggle_ao()
 
+                if self.is_saving:
+                    self.is_saving = False
+                    self.save_textures()
+
             elif self.processing_thread.type == "verifying":
                 mismatched_pixels = self.processing_thread.mismatched_pixels
 
@@ -263,9 +327,8 @@ class GUI(QMainWindow):
 
     def set_image(self, label, layout, width, height, image, remove_alpha=True):
         try:
-            image = image.convert("RGBA")
-            if remove_alpha:
-                image.putalpha(Image.new('L', image.size, 255))
+            # only the cached display size is converted, never the full resolution texture
+            image = self.display_cache.view(image, max(width, height), remove_alpha)
 
             pixmap = QPixmap.fromImage(ImageQt(image))
             pixmap = pixmap.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio,
@@ -277,8 +340,7 @@ class GUI(QMainWindow):
 
     def set_icon(self, image, icon_widget):
         try:
-            image = image.convert("RGBA")
-            image.putalpha(Image.new('L', image.size, 255))
+            image = self.display_cache.icon(image)
             pixmap = QPixmap.fromImage(ImageQt(image))
             icon_widget.setIcon(QIcon(pixmap))
         except Exception:
@@ -291,27 +353,30 @@ class GUI(QMainWindow):
 
             if filepath[0] != "":
                 texture_input.setText(filepath[0])
-                self.set_icon(Image.open(filepath[0]), icon)
+                if image_type != "ao":
+                    self.preview_set = None
+                    self.corrected_parameters = None
+                self.set_icon(self.texture_store.open(filepath[0]), icon)
 
             if is_set_image:
-                self.active_image = Image.open(filepath[0])
-                self.set_image(self.active_image_label, self.active_image_layout, 650, 650, Image.open(filepath[0]))
+                self.active_image = self.texture_store.open(filepath[0])
+                self.set_image(self.active_image_label, self.active_image_layout, 650, 650, self.active_image)
 
             if image_type == "ao":
                 self.status_label.setText("Ambient Occlusion was loaded successfully")
-                self.ao_image = Image.open(filepath[0]).convert("RGB")
+                self.ao_image = self.texture_store.open(filepath[0], "RGB")
 
             if image_type == "albedo":
                 self.status_label.setText("Albedo texture was loaded successfully")
-                self.albedo_image = Image.open(filepath[0])
+                self.albedo_image = self.texture_store.open(filepath[0])
 
             if image_type == "metallic":
                 self.status_label.setText("Metallic texture was loaded successfully")
-                self.metallic_image = Image.open(filepath[0])
+                self.metallic_image = self.texture_store.open(filepath[0])
 
             if image_type == "roughness":
                 self.status_label.setText("Roughness texture was loaded successfully")
-                self.roughness_image = Image.open(filepath[0]).convert("RGB")
+                self.roughness_image = self.texture_store.open(filepath[0], "RGB")
 
             self.toggle_ao()
         except Exception:
@@ -336,11 +401,12 @@ class GUI(QMainWindow):
 
         if valid_inputs:
             self.central_widget.setEnabled(False)
+            self.preview_type = "correcting"
 
             self.processing_thread.type = "correcting"
             self.processing_thread.albedo = self.albedo_image
-            self.processing_thread.metallic = self.metallic_image
-            self.processing_thread.roughness = self.roughness_image
+            self.processing_thread.metallic = self.resized_texture(self.metallic_image)
+            self.processing_thread.roughness = self.resized_texture(self.roughness_image)
             self.processing_thread.mode = self.mode
             self.processing_thread.limit_values = [self.l_min, self.l_max, self.b_limit]
             self.processing_thread.is_compensating = self.is_compensating
@@ -365,10 +431,11 @@ class GUI(QMainWindow):
 
         if valid_inputs:
             self.central_widget.setEnabled(False)
+            self.preview_type = "verifying"
 
             self.processing_thread.type = "verifying"
             self.processing_thread.albedo = self.albedo_image
-            self.processing_thread.metallic = self.metallic_image
+            self.processing_thread.metallic = self.resized_texture(self.metallic_image)
             self.processing_thread.mode = self.mode
             self.processing_thread.limit_values = [self.l_min, self.l_max, self.b_limit]
             self.processing_thread.start()
@@ -377,6 +444,12 @@ class GUI(QMainWindow):
             self.status_label.setText("Please make sure you have attached valid textures")
 
     def save_textures(self):
+        # previews are only proxies, the full resolution correction runs right before saving
+        if self.albedo_image is not None and self.corrected_parameters != self.current_parameters():
+            self.correct_albedo()
+            self.is_saving = self.processing_thread.isRunning()
+            return
+
         if self.pbr_set is not None:
             selected_directory = None
             directory = os.path.dirname(self.albedo_path_input.text())
@@ -397,12 +470,59 @@ class GUI(QMainWindow):
         else:
             self.status_label.setText("Nothing to save")
 
+    def resized_texture(self, image):
+        # resized once per albedo size, so repeated runs hand PBRSet maps it does not need to resize
+        if image is None:
+            return None
+
+        return self.texture_store.resize(image, self.albedo_image.size)
+
+    def current_parameters(self):
+        return self.mode, [self.l_min, self.l_max, self.b_limit], self.is_compensating, self.compensation_coefficient
+
+    def processing_parameters(self):
+        thread = self.processing_thread
+        return thread.mode, thread.limit_values, thread.is_compensating, thread.compensation_coefficient
+
+    def update_preview(self):
+        if self.albedo_image is None or not self.central_widget.isEnabled():
+            return
+
+        if self.mode == "combined" and self.metallic_image is None:
+            return
+
+        try:
+            if self.preview_set is None:
+                pbr_set = PBRSet(self.albedo_image, self.metallic_image, kernel=self.kernel, transfer=self.transfer,
+                                 engine=self.engine, lut_size=self.lut_size, workers=self.threads)
+                self.preview_set = pbr_set.proxy(PREVIEW_SIZE)
+
+            limit_values = [self.l_min, self.l_max, self.b_limit]
+
+            # roughness is not displayed, so the proxy skips compensation
+            if self.preview_type == "verifying":
+                mismatched_pixels = self.preview_set.verify_albedo(limit_values, self.mode)
+                self.active_image = self.preview_set.albedo_verified
+                percent_correct = 100 - round(mismatched_pixels / self.preview_set.size() * 100)
+                self.status_label.setText(f"Preview: {percent_correct}% correct")
+            else:
+                self.preview_set.correct_albedo(self.mode, limit_values)
+                self.active_image = self.preview_set.albedo_corrected
+                self.status_label.setText("Preview: press Correct or Save to process the full resolution")
+
+            self.status_label.setStyleSheet("color: rgba(168, 168, 168, 0.582);")
+            self.toggle_ao()
+        except Exception:
+            pass
+
     def compensating_state_changed(self):
         self.is_compensating = self.is_compensating_box.isChecked()
         self.compensation_coefficient_box.setEnabled(self.is_compensating)
+        self.preview_timer.start()
 
     def compensating_coeff_changed(self):
         self.compensation_coefficient = self.compensation_coefficient_box.value()
+        self.preview_timer.start()
 
     def mode_changed(self):
         self.finish_style = self.finish_style_box.currentText()
@@ -443,10 +563,13 @@ class GUI(QMainWindow):
             self.l_max_box.setEnabled(True)
             self.b_limit_box.setEnabled(False)
 
+        self.preview_timer.start()
+
     def range_changed(self):
         self.l_min = self.l_min_box.value()
         self.l_max = self.l_max_box.value()
         self.b_limit = self.b_limit_box.value()
+        self.preview_timer.start()
 
     def toggle_ao(self):
         if self.show_ao_box.isChecked():
@@ -455,7 +578,8 @@ class GUI(QMainWindow):
                 self.set_image(self.active_image_label, self.active_image_layout, 650, 650, self.active_image)
 
             elif self.active_image is not None:
-                self.set_image(self.active_image_label, self.active_image_layout, 650, 650, ImageChops.multiply(self.active_image.convert("RGB"), self.ao_image))
+                self.set_image(self.active_image_label, self.active_image_layout, 650, 650,
+                               self.display_cache.ambient_occlusion(self.active_image, self.ao_image))
             else:
                 self.set_image(self.active_image_label, self.active_image_layout, 650, 650, self.ao_image)
 
@@ -1,4 +1,8 @@
-from PIL import Image, ImageChops
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from PIL import Image
 import numpy as np
 import numexpr as ne
 
@@ -18,6 +22,73 @@ def linear_to_srgb(image_data=None):
 
         return srgb_data
 
+# 8-bit input only has 256 possible values, the table is built from float32 input like the reference path
+SRGB_DECODE_LUT = srgb_to_linear(np.arange(256, dtype=np.float32))
+
+# float32 rounding of the interpolation, well below the sag of any segment
+SRGB_ENCODE_LUT_MARGIN = 1e-4
+
+
+def srgb_encode_table(size, samples=64):
+    # linear_to_srgb is concave, so a chord between two entries always lies below the curve and truncation would
+    # take a level off half of the unchanged pixels; each entry is raised by the largest sag of its two segments,
+    # which keeps every interpolated value at or above the curve and at most two sags over it
+    linear = np.linspace(0, 255, (size - 1) * samples + 1)
+    curve = linear_to_srgb(linear).reshape(-1)
+    table = curve[::samples]
+
+    fraction = np.linspace(0, 1, samples + 1)
+    segments = curve[np.arange(size - 1)[:, np.newaxis] * samples + np.arange(samples + 1)]
+    chords = table[:-1, np.newaxis] + fraction * (table[1:] - table[:-1])[:, np.newaxis]
+    sag = (segments - chords).max(axis=1)
+
+    return table + np.maximum(np.append(sag, 0), np.insert(sag, 0, 0)) + SRGB_ENCODE_LUT_MARGIN
+
+
+# linear interpolation between 4096 entries stays within 0.005 above linear_to_srgb and never below it,
+# so after truncation to uint8 a pixel can only move up by one level, and only just below a level
+SRGB_ENCODE_LUT_SIZE = 4096
+SRGB_ENCODE_LUT = srgb_encode_table(SRGB_ENCODE_LUT_SIZE)
+
+
+def srgb_to_linear_lut(image_data=None):
+    if image_data is not None:
+        return SRGB_DECODE_LUT[np.asarray(image_data).astype(np.uint8, copy=False)]
+
+
+def linear_to_srgb_lut(image_data=None):
+    if image_data is not None:
+        table = SRGB_ENCODE_LUT.astype(np.result_type(image_data, np.float32), copy=False)
+        position = np.clip(image_data, 0, 255) * table.dtype.type((SRGB_ENCODE_LUT_SIZE - 1) / 255)
+        index = np.minimum(position.astype(np.int32), SRGB_ENCODE_LUT_SIZE - 2)
+        position -= index
+        lower = table[index]
+
+        return lower + position * (table[index + 1] - lower)
+
+
+# the exact curves in plain NumPy, in double precision like numexpr evaluates them with float literals
+def srgb_to_linear_numpy(image_data=None):
+    if image_data is not None:
+        image_data = np.asarray(image_data / 255, dtype=np.float64)
+
+        return np.where(image_data <= 0.04045, image_data / 12.92, ((image_data + 0.055) / 1.055) ** 2.4) * 255
+
+
+def linear_to_srgb_numpy(image_data=None):
+    if image_data is not None:
+        image_data = np.asarray(image_data / 255, dtype=np.float64)
+
+        return np.where(image_data <= 0.0031308, image_data * 12.92, image_data ** (1.0 / 2.4) * 1.055 - 0.055) * 255
+
+
+TRANSFER_FUNCTIONS = {
+    "exact": (srgb_to_linear, linear_to_srgb),
+    "lut": (srgb_to_linear_lut, linear_to_srgb_lut),
+    "numpy": (srgb_to_linear_numpy, linear_to_srgb_numpy),
+}
+
+
 def calculate_luminance(image_data=None):
     if image_data is not None:
         luminance_data = np.dot(image_data, [0.299, 0.587, 0.114])
@@ -25,29 +96,147 @@ def calculate_luminance(image_data=None):
         return luminance_data
 
 
+def clamp_brightness_data(image_data=None, brightness_limit=52):
+    if image_data is not None:
+        # the HSV value channel is the per-pixel maximum of R, G and B
+        value_data = image_data.max(axis=-1).astype(np.float32)
+        value_data = np.clip(np.power(value_data, value_data / brightness_limit), 0, 255).astype(np.uint8)
+
+        # same rounding as ImageChops.multiply
+        return (image_data * value_data[..., np.newaxis].astype(np.uint16) // 255).astype(np.uint8)
+
+
+def unclamp_brightness_data(image_data, brightness_limit):
+    value_data = image_data.max(axis=-1).astype(np.float32)
+    v_data = ((255 - value_data) / (255 / brightness_limit)).astype(np.uint8)
+
+    return np.minimum(image_data + v_data[..., np.newaxis].astype(np.uint16), 255).astype(np.uint8)
+
+
 def clamp_brightness(image=None, brightness_limit=52):
     if image is not None:
-        img = image.convert("HSV")
-        img_data = np.array(img, dtype=np.float32)
-        img_data[:, :, 2] = np.clip(np.power(img_data[:, :, 2], img_data[:, :, 2] / brightness_limit), 0, 255)
-        result = ImageChops.multiply(image, Image.fromarray(img_data[:, :, 2].astype('uint8')).convert('RGB'))
+        return Image.fromarray(clamp_brightness_data(np.asarray(image.convert("RGB")), brightness_limit))
+
+
+def unclamp_brightness(image, brightness_limit):
+    return Image.fromarray(unclamp_brightness_data(np.asarray(image.convert("RGB")), brightness_limit))
+
+
+def blend_by_mask(image_data, overlay_data, mask_data):
+    # same rounding as Image.paste with an "L" mask
+    mask_data = mask_data[..., np.newaxis].astype(np.uint32)
+    blended = image_data * (255 - mask_data) + overlay_data * mask_data + 128
+
+    return (((blended >> 8) + blended) >> 8).astype(np.uint8)
+
+
+# measured with benchmark_mask at 2048px: gathering pays while the covered pixels plus the partially covered ones,
+# which are gathered again to blend, stay under half the image; computing every pixel and restoring the rest only
+# pays while the uncovered and twice the partial pixels stay under a quarter, dense blending is faster in between
+SPARSE_MASK_RATIO = 0.5
+DENSE_MASK_RATIO = 0.25
+
+
+def apply_by_mask(image_data, mask_data, function, *args):
+    # equivalent to blend_by_mask(image_data, function(image_data, *args), mask_data) for per-pixel functions,
+    # but only the side of the mask with fewer pixels is gathered and only partially covered pixels are blended
+    covered = mask_data > 0
+    covered_count = np.count_nonzero(covered)
+
+    if covered_count == 0:
+        return image_data.copy()
+
+    partial_count = covered_count - np.count_nonzero(mask_data == 255)
+
+    if covered_count + partial_count <= SPARSE_MASK_RATIO * covered.size:
+        result = image_data.copy()
+        covered_data = image_data[covered]
+        covered_mask = mask_data[covered]
+        overlay_data = function(covered_data, *args)
+
+        partial = covered_mask < 255
+        overlay_data[partial] = blend_by_mask(covered_data[partial], overlay_data[partial], covered_mask[partial])
+        result[covered] = overlay_data
 
         return result
 
+    if covered.size - covered_count + 2 * partial_count > DENSE_MASK_RATIO * covered.size:
+        return blend_by_mask(image_data, function(image_data, *args), mask_data)
 
-def unclamp_brightness(image, brightness_limit):
-    img = image.convert("HSV")
-    img_data = np.array(img, dtype=np.float32)
-    v_data = (255 - img_data[:, :, 2]) / (255 / brightness_limit)
+    result = function(image_data, *args)
+    uncovered = ~covered
+    result[uncovered] = image_data[uncovered]
 
-    return ImageChops.add(image, Image.fromarray(v_data.astype('uint8')).convert('RGB'))
+    partial = covered & (mask_data < 255)
+    result[partial] = blend_by_mask(image_data[partial], result[partial], mask_data[partial])
 
+    return result
 
-def correct_range(image_data, limit_values):
-    image_data = np.clip(image_data, 1, 255)
-    linear_rgb = srgb_to_linear(image_data)
 
-    luminance_data = calculate_luminance(linear_rgb)
+# the palette engine pays for itself when there are fewer unique colors than this fraction of the pixels
+PALETTE_RATIO_LIMIT = 0.5
+
+# below this the 2^24 entry tables cost more than the dense kernels, even for a handful of colors
+PALETTE_MIN_PIXELS = 256 * 256
+
+
+def pack_colors(image_data):
+    image_data = image_data.astype(np.uint32)
+
+    return (image_data[..., 0] << 16) | (image_data[..., 1] << 8) | image_data[..., 2]
+
+
+def unpack_colors(keys):
+    return np.stack(((keys >> 16) & 255, (keys >> 8) & 255, keys & 255), axis=-1).astype(np.uint8)
+
+
+def color_keys(image_data):
+    # the packed colors and a 2^24 entry table of the ones present, instead of np.unique it stays linear in pixels
+    keys = pack_colors(image_data)
+    present = np.zeros(1 << 24, dtype=bool)
+    present[keys] = True
+
+    return keys, present
+
+
+def count_colors(image_data, counted=None):
+    return np.count_nonzero((color_keys(image_data) if counted is None else counted)[1])
+
+
+def find_palette(image_data, counted=None):
+    # counted is what color_keys returned for image_data, when the colors were already counted
+    keys, present = color_keys(image_data) if counted is None else counted
+    palette_keys = np.flatnonzero(present).astype(np.uint32)
+
+    index = np.empty(1 << 24, dtype=np.uint32)
+    index[palette_keys] = np.arange(len(palette_keys), dtype=np.uint32)
+
+    return unpack_colors(palette_keys), index[keys]
+
+
+def apply_by_palette(image_data, function, *args, palette=None):
+    # runs a per-pixel function once per distinct color and scatters the results back
+    palette_data, inverse = find_palette(image_data) if palette is None else palette
+    result = function(palette_data[np.newaxis], *args)
+
+    return result[0][inverse]
+
+
+def memoize_colors(function, source=None, palette=None):
+    # palette is the find_palette result of source, reused when the function is applied to source itself
+    def memoized(image_data, *args):
+        return apply_by_palette(image_data, function, *args, palette=palette if image_data is source else None)
+
+    return memoized
+
+
+def decode_luminance(image_data, transfer="exact"):
+    linear_rgb = TRANSFER_FUNCTIONS[transfer][0](image_data)
+
+    return linear_rgb, calculate_luminance(linear_rgb)
+
+
+def correct_linear_range(linear_rgb, luminance_data, limit_values, transfer="exact"):
     luminance_data_corrected = np.clip(luminance_data, limit_values[0], limit_values[1])
     luminance_lightening_factor = np.clip(luminance_data_corrected - luminance_data, 0, 255)
     luminance_darkening_factor = np.clip(luminance_data - luminance_data_corrected, 0, 255)
@@ -56,16 +245,394 @@ def correct_range(image_data, limit_values):
     linear_rgb_lightened = linear_rgb + luminance_lightening_factor[:, :, np.newaxis] * color_ratios
     linear_rgb_corrected = np.clip(linear_rgb_lightened - luminance_darkening_factor[:, :, np.newaxis], 0, 255)
 
-    image_data = linear_to_srgb(linear_rgb_corrected)
+    image_data = TRANSFER_FUNCTIONS[transfer][1](linear_rgb_corrected)
 
     return image_data
 
 
-def verify_range(image_data, limit_values):
-    linear_rgb = srgb_to_linear(image_data)
-    luminance_data = calculate_luminance(linear_rgb)
+def correct_range(image_data, limit_values, transfer="exact"):
+    image_data = np.clip(image_data, 1, 255)
+    linear_rgb, luminance_data = decode_luminance(image_data, transfer)
+
+    return correct_linear_range(linear_rgb, luminance_data, limit_values, transfer)
+
+
+def correct_range_reference(image_data, limit_values, out=None, transfer="exact"):
+    if out is None:
+        out = np.empty(image_data.shape, dtype=np.uint8)
+
+    out[...] = correct_range(image_data.astype(np.float32), limit_values, transfer)
+
+    return out
+
+
+FUSED_CONSTANTS = {
+    'decode_threshold': 0.04045 * 255,
+    'encode_threshold': 0.0031308,
+    'slope': 12.92,
+    'offset': 0.055,
+    'scale': 1.055,
+    'gamma': 2.4,
+    'inverse_gamma': 1.0 / 2.4,
+    'r_weight': 0.299,
+    'g_weight': 0.587,
+    'b_weight': 0.114,
+}
+
+
+def correct_range_fused(image_data, limit_values, out=None, transfer="exact"):
+    if out is None:
+        out = np.empty(image_data.shape, dtype=np.uint8)
+
+    # constants are passed as float32 variables, float literals would make numexpr upcast to float64
+    constants = {name: np.float32(value) for name, value in FUSED_CONSTANTS.items()}
+    constants['l_min'] = np.float32(limit_values[0])
+    constants['l_max'] = np.float32(limit_values[1])
+
+    if transfer == "lut":
+        rgb = SRGB_DECODE_LUT.astype(np.float32)[np.maximum(image_data, 1)]
+    else:
+        rgb = image_data.astype(np.float32)
+        ne.evaluate('where(rgb <= decode_threshold, where(rgb < 1, 1, rgb) / slope, '
+                    '((rgb / 255 + offset) / scale) ** gamma * 255)',
+                    local_dict=dict(constants, rgb=rgb), out=rgb)
+
+    luminance = ne.evaluate('r_weight * r + g_weight * g + b_weight * b',
+                            local_dict=dict(constants, r=rgb[:, :, 0], g=rgb[:, :, 1], b=rgb[:, :, 2]))
+
+    # lighten by the luminance ratio, darken by the luminance excess, clip and encode back to sRGB
+    ne.evaluate('where(luminance < l_min, rgb * l_min / luminance, '
+                'where(luminance > l_max, rgb - (luminance - l_max), rgb))',
+                local_dict=dict(constants, rgb=rgb, luminance=luminance[:, :, np.newaxis]), out=rgb)
+    ne.evaluate('where(rgb < 0, 0, where(rgb > 255, 255, rgb))', local_dict={'rgb': rgb}, out=rgb)
+
+    if transfer == "lut":
+        rgb = linear_to_srgb_lut(rgb)
+    else:
+        ne.evaluate('where(rgb / 255 <= encode_threshold, rgb / 255 * slope, '
+                    '(rgb / 255) ** inverse_gamma * scale - offset) * 255',
+                    local_dict=dict(constants, rgb=rgb), out=rgb)
+
+    np.copyto(out, rgb, casting='unsafe')
+
+    return out
+
 
+RANGE_KERNELS = {
+    "reference": correct_range_reference,
+    "fused": correct_range_fused,
+}
+
+
+def verify_luminance(image_data, luminance_data, limit_values):
     image_data[(luminance_data < limit_values[0])] = [0, 0, 255]
     image_data[(luminance_data > limit_values[1])] = [255, 0, 0]
 
     return image_data
+
+
+def verify_range(image_data, limit_values, transfer="exact"):
+    _, luminance_data = decode_luminance(image_data, transfer)
+
+    return verify_luminance(image_data, luminance_data, limit_values)
+
+
+def row_bands(height, tile_rows=None):
+    if not tile_rows or tile_rows >= height:
+        yield slice(0, height)
+        return
+
+    for row in range(0, height, tile_rows):
+        yield slice(row, min(row + tile_rows, height))
+
+
+def stack_bands(count, height, tile_rows=None):
+    # row bands of count images stacked into one tall image, no band crosses into the next image
+    for index in range(count):
+        for band in row_bands(height, tile_rows):
+            yield slice(index * height + band.start, index * height + band.stop)
+
+
+def worker_count(workers=1):
+    # 0 or None means one worker per core
+    return workers or os.cpu_count() or 1
+
+
+@lru_cache(maxsize=None)
+def thread_pool(workers):
+    return ThreadPoolExecutor(workers)
+
+
+def for_row_bands(function, height, tile_rows=None, workers=1, count=1):
+    workers = worker_count(workers)
+
+    if workers == 1:
+        for band in stack_bands(count, height, tile_rows):
+            function(band)
+        return
+
+    # numpy releases the GIL inside ufuncs, a few bands per worker evens out bands that take longer
+    tile_rows = min(tile_rows or height, -(-height * count // (workers * 4)))
+    for _ in thread_pool(workers).map(function, stack_bands(count, height, tile_rows)):
+        pass
+
+
+def correct_range_tiled(image_data, limit_values, tile_rows=None, out=None, kernel="reference", transfer="exact",
+                        workers=1):
+    if out is None:
+        out = np.empty(image_data.shape, dtype=np.uint8)
+
+    correct = RANGE_KERNELS[kernel]
+    for_row_bands(lambda band: correct(image_data[band], limit_values, out=out[band], transfer=transfer),
+                  image_data.shape[0], tile_rows, workers)
+
+    return out
+
+
+def verify_range_tiled(image_data, limit_values, tile_rows=None, out=None, transfer="exact", workers=1):
+    if out is None:
+        out = np.empty(image_data.shape, dtype=np.uint8)
+
+    def verify(band):
+        out[band] = verify_range(image_data[band].astype(np.float32), limit_values, transfer)
+
+    for_row_bands(verify, image_data.shape[0], tile_rows, workers)
+
+    return out
+
+
+def luminance_statistics(image_data, luminance_data, limit_values, below=None, above=None):
+    # the masks are written into below and above when given, e.g. row bands of full-size masks
+    below = np.less(luminance_data, limit_values[0], out=below)
+    above = np.greater(luminance_data, limit_values[1], out=above)
+    levels = np.clip(luminance_data, 0, 255).astype(np.uint8)
+
+    return {
+        "pixels": luminance_data.size,
+        "below": int(np.count_nonzero(below)),
+        "above": int(np.count_nonzero(above)),
+        "histogram": np.bincount(levels.ravel(), minlength=256),
+        # one strided reduction per channel, reducing over both pixel axes at once is an order of magnitude slower
+        "channel_min": np.array([image_data[..., channel].min() for channel in range(image_data.shape[-1])]),
+        "channel_max": np.array([image_data[..., channel].max() for channel in range(image_data.shape[-1])]),
+    }
+
+
+def merge_statistics(statistics):
+    return {
+        "pixels": sum(part["pixels"] for part in statistics),
+        "below": sum(part["below"] for part in statistics),
+        "above": sum(part["above"] for part in statistics),
+        "histogram": np.sum([part["histogram"] for part in statistics], axis=0),
+        "channel_min": np.min([part["channel_min"] for part in statistics], axis=0),
+        "channel_max": np.max([part["channel_max"] for part in statistics], axis=0),
+    }
+
+
+def verify_statistics_tiled(image_data, limit_values, tile_rows=None, transfer="exact", workers=1, masks=False):
+    statistics, below, above = verify_statistics_stack(image_data[np.newaxis], limit_values, tile_rows, transfer,
+                                                       workers, masks)
+
+    return statistics[0], below[0] if masks else None, above[0] if masks else None
+
+
+def verify_statistics_stack(image_stack, limit_values, tile_rows=None, transfer="exact", workers=1, masks=False,
+                            prepare=None):
+    # counts and histogram in one pass over the luminance, the full-size masks are only kept for an overlay;
+    # an (N, H, W, C) stack is processed as one tall image and split into statistics per image, prepare maps
+    # each band before it is checked while the band is still in cache
+    count, height = image_stack.shape[:2]
+    image_data = image_stack.reshape((count * height,) + image_stack.shape[2:])
+    below = np.empty(image_data.shape[:2], dtype=bool) if masks else None
+    above = np.empty(image_data.shape[:2], dtype=bool) if masks else None
+    statistics = {}
+
+    def verify(band):
+        band_data = prepare(band, image_data[band]) if prepare is not None else image_data[band]
+        _, luminance_data = decode_luminance(band_data.astype(np.float32), transfer)
+        statistics[band.start] = luminance_statistics(band_data, luminance_data, limit_values,
+                                                      below[band] if masks else None,
+                                                      above[band] if masks else None)
+
+    for_row_bands(verify, height, tile_rows, workers, count)
+
+    starts = sorted(statistics)
+    statistics = [merge_statistics([statistics[start] for start in starts if start // height == index])
+                  for index in range(count)]
+
+    if masks:
+        below = below.reshape(count, height, -1)
+        above = above.reshape(count, height, -1)
+
+    return statistics, below, above
+
+
+def verification_overlay(image_data, below, above):
+    overlay = image_data.copy()
+    overlay[below] = [0, 0, 255]
+    overlay[above] = [255, 0, 0]
+
+    return overlay
+
+
+def decode_clipped(image_data, transfer="exact"):
+    # the linear values correct_range works on, the decode table equals the exact curve for 8-bit input
+    if transfer in ["exact", "lut"]:
+        return SRGB_DECODE_LUT[np.maximum(image_data, 1)]
+
+    return TRANSFER_FUNCTIONS[transfer][0](np.clip(image_data.astype(np.float32), 1, 255))
+
+
+def luminance_tiled(image_data, transfer="exact", clip=False, tile_rows=None, workers=1):
+    # only the luminance is kept, linear RGB never exists at full size
+    luminance_data = np.empty(image_data.shape[:2])
+
+    def luminance(band):
+        if clip:
+            luminance_data[band] = calculate_luminance(decode_clipped(image_data[band], transfer))
+        else:
+            luminance_data[band] = decode_luminance(image_data[band].astype(np.float32), transfer)[1]
+
+    for_row_bands(luminance, image_data.shape[0], tile_rows, workers)
+
+    return luminance_data
+
+
+def correct_luminance_tiled(image_data, luminance_data, limit_values, tile_rows=None, transfer="exact", workers=1):
+    # correct_range with a kept luminance, linear RGB is decoded again per band
+    out = np.empty(image_data.shape, dtype=np.uint8)
+
+    def correct(band):
+        linear_rgb = decode_clipped(image_data[band], transfer)
+        np.copyto(out[band], correct_linear_range(linear_rgb, luminance_data[band], limit_values, transfer),
+                  casting='unsafe')
+
+    for_row_bands(correct, image_data.shape[0], tile_rows, workers)
+
+    return out
+
+
+# PIL's convert("L") weights in 16 bit fixed point, any weighted sum of uint8 values is exact in float32
+GRAYSCALE_WEIGHTS = np.array([19595, 38470, 7471], dtype=np.float32)
+
+
+def compensation_factors(albedo_data, corrected_data, tile_rows=256, workers=1):
+    lightening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8)
+    darkening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8)
+
+    def factors(rows):
+        difference = corrected_data[rows, :, :3].astype(np.float32)
+        difference -= albedo_data[rows, :, :3]
+
+        # rounding and the 16 bit shift of convert("L"), truncation is the shift
+        lightening = np.maximum(difference, 0) @ GRAYSCALE_WEIGHTS
+        darkening = np.minimum(difference, 0) @ GRAYSCALE_WEIGHTS
+        np.copyto(lightening_data[rows], (lightening + 0x8000) / 0x10000, casting='unsafe')
+        np.copyto(darkening_data[rows], (0x8000 - darkening) / 0x10000, casting='unsafe')
+
+    for_row_bands(factors, albedo_data.shape[0], tile_rows, workers)
+
+    return lightening_data, darkening_data
+
+
+def contrast_lut(image_data, factor):
+    # ImageEnhance.Contrast blends from the rounded mean in single precision and truncates the result
+    mean = np.float32(int(image_data.mean(dtype=np.float64) + 0.5))
+    values = mean + np.float32(factor) * (np.arange(256, dtype=np.float32) - mean)
+
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+def compensate_roughness(roughness_data, lightening_data, darkening_data, coefficient=1.0, tile_rows=256, workers=1):
+    factor = coefficient ** 3.14
+    lightening_lut = contrast_lut(lightening_data, factor)
+    darkening_lut = contrast_lut(darkening_data, factor)
+    out = np.empty(roughness_data.shape, dtype=np.uint8)
+
+    def compensate(rows):
+        # repeated per channel up front, broadcasting over a last axis of three is much slower
+        shape = roughness_data[rows].shape
+        lightening = np.repeat(lightening_lut[lightening_data[rows]], shape[-1]).reshape(shape)
+        darkening = np.repeat(darkening_lut[darkening_data[rows]], shape[-1]).reshape(shape)
+
+        # saturating subtract and add that stay in uint8, like ImageChops.subtract and ImageChops.add
+        compensated = out[rows]
+        np.maximum(roughness_data[rows], lightening, out=compensated)
+        compensated -= lightening
+        np.subtract(255, darkening, out=lightening)
+        np.minimum(compensated, lightening, out=compensated)
+        compensated += darkening
+
+    for_row_bands(compensate, roughness_data.shape[0], tile_rows, workers)
+
+    return out
+
+
+def bake_color_lut(function, *args, size=256, tile_rows=256, workers=1):
+    # size 256 covers every 8-bit color and is exact, smaller lattices are sampled at the nearest 8-bit colors
+    # and applied with trilinear interpolation
+    if size == 256:
+        colors = unpack_colors(np.arange(1 << 24, dtype=np.uint32)).reshape(4096, 4096, 3)
+    else:
+        grid = np.rint(np.linspace(0, 255, size)).astype(np.uint8)
+        colors = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1).reshape(size * size, size, 3)
+
+    # the colors of a band do not depend on the other bands, the workers bake the whole stage band by band
+    lut = np.empty(colors.shape, dtype=np.uint8)
+
+    def bake(band):
+        lut[band] = function(colors[band], *args)
+
+    for_row_bands(bake, colors.shape[0], tile_rows, workers)
+
+    return lut.reshape(size, size, size, -1)
+
+
+def apply_color_lut(image_data, lut, tile_rows=256):
+    size = lut.shape[0]
+
+    if size == 256:
+        return lut.reshape(-1, lut.shape[-1])[pack_colors(image_data)]
+
+    out = np.empty(image_data.shape[:-1] + lut.shape[-1:], dtype=np.uint8)
+    lut = lut.astype(np.float32).reshape(-1, lut.shape[-1])
+    r_step, g_step = size * size, size
+
+    for band in row_bands(image_data.shape[0], tile_rows):
+        position = image_data[band].astype(np.float32) * np.float32((size - 1) / 255)
+        index = np.minimum(position.astype(np.int32), size - 2)
+        fraction = (position - index)[..., np.newaxis]
+        fr, fg, fb = fraction[..., 0, :], fraction[..., 1, :], fraction[..., 2, :]
+        base = index[..., 0] * r_step + index[..., 1] * g_step + index[..., 2]
+
+        # interpolate along b, then g, then r
+        c00 = lut[base]
+        c00 += fb * (lut[base + 1] - c00)
+        c01 = lut[base + g_step]
+        c01 += fb * (lut[base + g_step + 1] - c01)
+        c10 = lut[base + r_step]
+        c10 += fb * (lut[base + r_step + 1] - c10)
+        c11 = lut[base + r_step + g_step]
+        c11 += fb * (lut[base + r_step + g_step + 1] - c11)
+        c00 += fg * (c01 - c00)
+        c10 += fg * (c11 - c10)
+        c00 += fr * (c10 - c00)
+
+        out[band] = np.clip(np.rint(c00), 0, 255)
+
+    return out
+
+
+def write_cube(path, lut, title=None):
+    size = lut.shape[0]
+
+    with open(path, 'w') as cube_file:
+        if title is not None:
+            cube_file.write(f'TITLE "{title}"\n')
+        cube_file.write(f"LUT_3D_SIZE {size}\n")
+        cube_file.write("DOMAIN_MIN 0.0 0.0 0.0\n")
+        cube_file.write("DOMAIN_MAX 1.0 1.0 1.0\n")
+
+        # .cube files list entries with red changing fastest, the table is indexed [r, g, b]
+        entries = lut.transpose(2, 1, 0, 3).reshape(-1, 3) / 255
+        np.savetxt(cube_file, entries, fmt="%.6f")
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+
+from .Backends import resolve_kernel
+
+MANIFEST_FILENAME = ".pbr_manifest.json"
+
+
+def file_digest(path):
+    hasher = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as texture_file:
+        for chunk in iter(lambda: texture_file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def build_parameters(cfg):
+    # everything that changes the written pixels, so a settings change rebuilds every set
+    return {
+        "mode": cfg.mode,
+        "limit_values": [cfg.l_min, cfg.l_max, cfg.b_limit],
+        "is_compensating": cfg.is_compensating,
+        "compensation_coefficient": cfg.compensation_coefficient,
+        # auto names the backend it picks on this machine
+        "kernel": resolve_kernel(cfg.kernel, cfg.transfer),
+        "transfer": cfg.transfer,
+        "engine": cfg.engine,
+        "lut_size": cfg.lut_size,
+    }
+
+
+def output_paths(texture_set, output_dir=None):
+    # the names PBRSet.save writes, the roughness output only exists when compensation ran
+    directory = output_dir or os.path.dirname(texture_set.albedo_path) or "."
+    paths = [directory + "/" + texture_set.name() + "_corrected" + ".tga"]
+
+    if texture_set.roughness_path is not None:
+        roughness_filename = os.path.basename(texture_set.roughness_path).split(".")[0]
+        paths.append(directory + "/" + roughness_filename + "_corrected" + ".tga")
+
+    return paths
+
+
+class BuildManifest:
+    def __init__(self, cfg, output_dir=None, hash_inputs=False):
+        self.parameters = build_parameters(cfg)
+        self.output_dir = output_dir
+        self.hash_inputs = hash_inputs
+        # one manifest file per output directory, loaded on first use
+        self.manifests = {}
+        self.changed = set()
+
+    def manifest_path(self, texture_set):
+        directory = self.output_dir or os.path.dirname(texture_set.albedo_path) or "."
+        return os.path.join(directory, MANIFEST_FILENAME)
+
+    def entries(self, texture_set):
+        path = self.manifest_path(texture_set)
+
+        if path not in self.manifests:
+            try:
+                with open(path) as manifest_file:
+                    self.manifests[path] = json.load(manifest_file)
+            except (OSError, ValueError):
+                self.manifests[path] = {}
+
+        return self.manifests[path]
+
+    def input_paths(self, texture_set):
+        return [path for path in (texture_set.albedo_path, texture_set.metallic_path, texture_set.roughness_path)
+                if path is not None]
+
+    def input_state(self, path, recorded=None):
+        stat = os.stat(path)
+        state = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+        if self.hash_inputs:
+            # an unchanged stat reuses the recorded digest, only touched files are read again
+            if recorded is not None and recorded.get("size") == state["size"] and \
+                    recorded.get("mtime") == state["mtime"] and "hash" in recorded:
+                state["hash"] = recorded["hash"]
+            else:
+                state["hash"] = file_digest(path)
+
+        return state
+
+    def is_stale(self, texture_set):
+        entry = self.entries(texture_set).get(os.path.abspath(texture_set.albedo_path))
+
+        if entry is None or entry["parameters"] != self.parameters:
+            return True
+
+        if not all(os.path.isfile(path) for path in entry["outputs"]):
+            return True
+
+        inputs = entry["inputs"]
+        if sorted(inputs) != sorted(os.path.abspath(path) for path in self.input_paths(texture_set)):
+            return True
+
+        for path, recorded in inputs.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+
+            if stat.st_size == recorded["size"] and stat.st_mtime_ns == recorded["mtime"]:
+                continue
+            # with hashing, a new mtime alone does not make the set stale
+            if not self.hash_inputs or "hash" not in recorded or file_digest(path) != recorded["hash"]:
+                return True
+
+            # the new stat is recorded so the next run does not read the file again
+            recorded["mtime"] = stat.st_mtime_ns
+            self.changed.add(self.manifest_path(texture_set))
+
+        return False
+
+    def stale(self, texture_sets):
+        return [texture_set for texture_set in texture_sets if self.is_stale(texture_set)]
+
+    def record(self, texture_set):
+        entries = self.entries(texture_set)
+        previous = entries.get(os.path.abspath(texture_set.albedo_path), {}).get("inputs", {})
+
+        entries[os.path.abspath(texture_set.albedo_path)] = {
+            "inputs": {os.path.abspath(path): self.input_state(path, previous.get(os.path.abspath(path)))
+                       for path in self.input_paths(texture_set)},
+            "parameters": self.parameters,
+            "outputs": [path for path in output_paths(texture_set, self.output_dir) if os.path.isfile(path)],
+        }
+        self.changed.add(self.manifest_path(texture_set))
+
+    def save(self):
+        for path in self.changed:
+            temporary_path = path + f".{os.getpid()}.tmp"
+            with open(temporary_path, 'w') as manifest_file:
+                json.dump(self.manifests[path], manifest_file, indent=1)
+            os.replace(temporary_path, path)
+
+        self.changed.clear()
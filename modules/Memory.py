@@ -0,0 +1,123 @@
+import tracemalloc
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from .PBR import PBRSet
+
+# the bytes per pixel are fitted through two sizes where the per-pixel arrays dominate the peak
+CALIBRATION_SIZES = (640, 1280)
+
+# fixed allocations such as the 2^24 entry color tables dominate a small texture with few colors, it sets the
+# intercept so the estimate covers the peak of the palette engine as well
+FIXED_CALIBRATION_SIZE = 256
+FIXED_CALIBRATION_COLORS = 256
+
+# PIL keeps RGB images as four bytes per pixel and allocates them outside of tracemalloc's view
+IMAGE_BYTES_PER_PIXEL = 4
+
+# interpreter, numpy and the decoded headers of a job, independent of the texture size; a fresh worker that
+# imported the modules is resident with about 46 MB
+JOB_OVERHEAD_BYTES = 48 * 1024 * 1024
+
+
+def model_key(task, mode, is_compensating):
+    return task, mode, task == "correct" and is_compensating and mode in ["metallic", "combined"]
+
+
+def traced_peak(options, size, task, mode, is_compensating, colors=None):
+    rng = np.random.default_rng(0)
+    albedo_data = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    if colors is not None:
+        albedo_data = albedo_data.reshape(-1, 3)[rng.integers(0, colors, (size, size))]
+    albedo = Image.fromarray(albedo_data)
+    metallic = Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8))
+    roughness = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+    pbr_set = PBRSet(albedo, metallic, roughness, **dict(options))
+
+    tracemalloc.start()
+    try:
+        if task == "correct":
+            pbr_set.correct_albedo(mode, [8, 235, 52], is_compensating, 0.9)
+        else:
+            # batches only count mismatches, the overlay is built in the GUI
+            pbr_set.verify_albedo([8, 235, 52], mode, overlay=False)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@lru_cache(maxsize=None)
+def calibrate_memory_model(options=(), sizes=CALIBRATION_SIZES):
+    # peak bytes traced per albedo pixel and fixed bytes for every task and mode, measured on synthetic sets
+    # processed with the same PBRSet options the batch uses
+    small, large = sizes
+    model = {}
+
+    for task in ["correct", "verify"]:
+        for mode in ["nonmetallic", "metallic", "combined"]:
+            for is_compensating in [False, True]:
+                key = model_key(task, mode, is_compensating)
+                if key in model:
+                    continue
+
+                small_peak, large_peak = [traced_peak(options, size, task, mode, is_compensating) for size in sizes]
+                fixed_peak = traced_peak(options, FIXED_CALIBRATION_SIZE, task, mode, is_compensating,
+                                         FIXED_CALIBRATION_COLORS)
+                bytes_per_pixel = max(large_peak - small_peak, 0) / (large * large - small * small)
+
+                # the smallest intercept that keeps every calibrated peak under the line
+                fixed_bytes = max(max(peak - bytes_per_pixel * size * size for size, peak in
+                                      [(small, small_peak), (large, large_peak),
+                                       (FIXED_CALIBRATION_SIZE, fixed_peak)]), 0)
+
+                model[key] = (bytes_per_pixel, fixed_bytes)
+
+    return model
+
+
+def estimate_peak_memory(pixels, task, mode, is_compensating, model):
+    key = model_key(task, mode, is_compensating)
+    images = 2 + (mode == "combined") + 2 * key[2]
+    bytes_per_pixel, fixed_bytes = model[key]
+
+    return int(pixels * (bytes_per_pixel + images * IMAGE_BYTES_PER_PIXEL) + fixed_bytes) + JOB_OVERHEAD_BYTES
+
+
+def texture_pixels(path):
+    # only the header is read, the pixels are decoded by the worker
+    with Image.open(path) as image:
+        return image.width * image.height
+
+
+class MemoryScheduler:
+    def __init__(self, budget, slots):
+        self.budget = budget
+        self.slots = slots
+        self.running = {}
+
+    def used(self):
+        return sum(self.running.values())
+
+    def admit(self, pending):
+        # the largest pending job that fits next to the running ones, so small jobs fill the cores
+        # while a large one waits for memory; an oversized job still runs once it would run alone
+        if len(self.running) >= self.slots or not pending:
+            return None
+
+        available = self.budget - self.used()
+        fitting = [index for index, (estimate, _) in enumerate(pending) if estimate <= available]
+
+        if fitting:
+            return pending.pop(max(fitting, key=lambda index: pending[index][0]))
+        if not self.running:
+            return pending.pop(max(range(len(pending)), key=lambda index: pending[index][0]))
+
+        return None
+
+    def start(self, job_id, estimate):
+        self.running[job_id] = estimate
+
+    def finish(self, job_id):
+        self.running.pop(job_id, None)
@@ -1,13 +1,133 @@
-from PIL import Image, ImageChops, ImageEnhance
+from functools import lru_cache, partial
+
+from PIL import Image
 import numpy as np
-from .ImageProcessing import clamp_brightness, unclamp_brightness, correct_range, verify_range
+from .ImageProcessing import apply_by_mask, correct_range_tiled, verify_range_tiled, color_keys, count_colors, \
+    bake_color_lut, apply_color_lut, write_cube, correct_luminance_tiled, luminance_tiled, compensate_roughness, \
+    worker_count, luminance_statistics, verify_statistics_tiled, verification_overlay, find_palette, memoize_colors, \
+    PALETTE_MIN_PIXELS, PALETTE_RATIO_LIMIT
+from .Backends import backend_kernel, resolve_kernel
+from .Verification import compact_mask, mask_from_arrays
+
+LUT_TILE_ROWS = 256
+
+# the kept luminance is built and used in bands, so full-size linear RGB never exists
+INCREMENTAL_TILE_ROWS = 256
+
+# color to color stages that only depend on the luminance limits
+RANGE_STAGES = ["correct", "verify"]
+
+# the engine option, auto counts the colors and picks the palette engine where it pays off
+ENGINES = ["dense", "palette", "lut", "auto"]
+
+# stages the lut engine takes from a table, the metallic table includes the unclamp
+LUT_STAGES = ["correct", "metallic"]
+
+# what verify_albedo leaves in albedo_statistics, cached next to the overlay
+VERIFY_STATISTICS = ["pixels", "below", "above", "histogram", "channel_min", "channel_max"]
+
+# a .cube file can only hold modes that do not depend on the metallic mask
+CUBE_STAGES = {
+    "nonmetallic": "correct",
+    "metallic": "metallic",
+}
+
+
+def stage_function(stage, kernel="reference", transfer="exact", tile_rows=None, workers=1):
+    correct_range = partial(correct_range_tiled, tile_rows=tile_rows, kernel=kernel, transfer=transfer,
+                            workers=workers)
+
+    if stage == "correct":
+        return correct_range
+
+    if stage == "verify":
+        return partial(verify_range_tiled, tile_rows=tile_rows, transfer=transfer, workers=workers)
+
+    if stage == "clamp":
+        return backend_kernel(kernel, "clamp")
+
+    if stage == "unclamp":
+        return backend_kernel(kernel, "unclamp")
+
+    if stage == "metallic":
+        unclamp_brightness = backend_kernel(kernel, "unclamp")
+
+        def correct_metallic(image_data, limit_values):
+            return unclamp_brightness(correct_range(image_data, limit_values), limit_values[2])
+
+        return correct_metallic
+
+    raise ValueError(f"unknown stage: {stage}")
+
+
+def proxy_factor(size, view_size):
+    # the smallest mip level that still covers the view
+    factor = 1
+    while max(size) // (factor * 2) >= view_size:
+        factor *= 2
+
+    return factor
+
+
+def proxy_textures(albedo_image, metallic_image=None, roughness_image=None, view_size=650):
+    if albedo_image.mode not in ["RGB", "RGBA"]:
+        albedo_image = albedo_image.convert("RGB")
+
+    factor = proxy_factor(albedo_image.size, view_size)
+    if factor > 1:
+        albedo_image = albedo_image.reduce(factor)
+
+    if metallic_image is not None:
+        # a palette mask is read through its luminance, see PBRSet.metallic_mask
+        if metallic_image.mode == 'P':
+            metallic_image = metallic_image.convert('L')
+        metallic_image = metallic_image.resize(albedo_image.size, Image.Resampling.BOX)
+
+    if roughness_image is not None:
+        roughness_image = roughness_image.resize(albedo_image.size, Image.Resampling.BOX)
+
+    return albedo_image, metallic_image, roughness_image
+
+
+def mask_image(metallic_image):
+    # the first channel is the mask, palette masks are read through their luminance
+    if metallic_image.mode != 'P':
+        return metallic_image.split()[0].convert('L')
+
+    return metallic_image.convert('L')
+
+
+# a full 256^3 table is 48 MB, keep only the last few parameter sets
+@lru_cache(maxsize=4)
+def stage_lut(stage, args, kernel, transfer, size, workers=1):
+    return bake_color_lut(stage_function(stage, kernel, transfer), *args, size=size, tile_rows=LUT_TILE_ROWS,
+                          workers=workers)
 
 
 class PBRSet:
-    def __init__(self, albedo_image=None, metallic_image=None, roughness_image=None):
+    def __init__(self, albedo_image=None, metallic_image=None, roughness_image=None, tile_rows=None,
+                 kernel="reference", transfer="exact", engine="dense", lut_size=256, cache=None, incremental=False,
+                 workers=1):
+        self.tile_rows = tile_rows
+        self.workers = worker_count(workers)
+        # auto is resolved once, cache keys and tables name the backend that actually ran
+        self.kernel = resolve_kernel(kernel, transfer)
+        self.transfer = transfer
+        self.engine = engine
+        self.lut_size = lut_size
+        self.cache = cache
+        self.incremental = incremental
+        self.intermediates = {}
+        self.proxies = {}
+        self.palette_chosen = None
+        self.albedo_palette = None
+        self.source_images = (albedo_image, metallic_image, roughness_image)
         self.albedo_image = None
         self.albedo_corrected = None
         self.albedo_verified = None
+        self.albedo_statistics = None
+        self.albedo_mask = None
+        self.verification = None
         self.metallic_image = None
         self.roughness_image = None
         self.roughness_corrected = None
@@ -15,91 +135,285 @@ class PBRSet:
         if albedo_image is not None:
             self.albedo_image = albedo_image
 
+        # maps already at the albedo size, e.g. from TextureStore.resize, are used as they are
         if metallic_image is not None:
-            self.metallic_image = metallic_image.resize(
-                (self.albedo_image.width, self.albedo_image.height))
+            self.metallic_image = metallic_image
+            if metallic_image.size != self.albedo_image.size:
+                self.metallic_image = metallic_image.resize((self.albedo_image.width, self.albedo_image.height))
 
         if roughness_image is not None:
-            self.roughness_image = roughness_image.resize(
-                (self.albedo_image.width, self.albedo_image.height))
+            self.roughness_image = roughness_image
+            if roughness_image.size != self.albedo_image.size:
+                self.roughness_image = roughness_image.resize((self.albedo_image.width, self.albedo_image.height))
 
     def correct_albedo(self, mode, limit_values, is_compensating=False, coefficient=1.0):
-        self.albedo_corrected = self.albedo_image.convert("RGB")
-        image_data = np.array(self.albedo_corrected, dtype=np.float32)
+        cache_key = self.cache_key("correct", mode, limit_values, is_compensating, coefficient)
+        cached = self.cached_result(cache_key)
 
-        corrected_data = correct_range(image_data, limit_values)
-        self.albedo_corrected = Image.fromarray(corrected_data.astype('uint8'))
+        if cached is not None:
+            self.albedo_corrected = Image.fromarray(cached["albedo_corrected"])
+            self.roughness_corrected = None
+            if cached.get("roughness_corrected") is not None:
+                self.roughness_corrected = Image.fromarray(cached["roughness_corrected"])
+            return
 
-        if mode == "metallic":
-            self.albedo_corrected = unclamp_brightness(self.albedo_corrected, limit_values[2])
+        self.albedo_corrected = self.intermediate("albedo_corrected", (mode, tuple(limit_values)),
+                                                  lambda: self.corrected_albedo(mode, limit_values))
+        self.roughness_corrected = None
 
-        if mode == "combined":
-            albedo_metallic_corrected = unclamp_brightness(self.albedo_corrected, limit_values[2])
+        if is_compensating and mode in ["metallic", "combined"]:
+            compensation_factors = backend_kernel(self.kernel, "compensation")
+            lightening_data, darkening_data = self.intermediate(
+                "compensation_factors", (mode, tuple(limit_values)),
+                lambda: compensation_factors(self.albedo_data(), np.asarray(self.albedo_corrected),
+                                             workers=self.workers))
+
+            roughness_data = self.intermediate("roughness_data", (),
+                                               lambda: np.asarray(self.roughness_image.convert("RGB")))
+            roughness_compensated = Image.fromarray(
+                compensate_roughness(roughness_data, lightening_data, darkening_data, coefficient,
+                                     workers=self.workers))
+
+            self.roughness_corrected = roughness_compensated
+
+        self.cache_result(cache_key, albedo_corrected=self.albedo_corrected,
+                          roughness_corrected=self.roughness_corrected)
 
-            if self.metallic_image.mode != 'P':
-                metallic_mask = self.metallic_image.split()[0]
-            else:
-                metallic_mask = self.metallic_image
+    def corrected_albedo(self, mode, limit_values):
+        image_data = self.albedo_data()
+        # with the lut engine metallic mode is a single table, the same one the stack engine and export_cube use
+        stage = "metallic" if self.engine == "lut" and mode == "metallic" else "correct"
+        correct_range, unclamp_brightness = self.color_functions(image_data, stage, "unclamp")
+        limits = tuple(limit_values) if stage == "metallic" else tuple(limit_values[:2])
 
-            metallic_mask = metallic_mask.convert('L')
+        corrected_data = self.intermediate("range_corrected", (stage, limits),
+                                           lambda: self.range_corrected(image_data, limit_values, correct_range))
 
-            self.albedo_corrected.paste(albedo_metallic_corrected, mask=metallic_mask)
+        if mode == "metallic" and stage == "correct":
+            corrected_data = unclamp_brightness(corrected_data, limit_values[2])
+
+        if mode == "combined":
+            corrected_data = apply_by_mask(corrected_data, self.metallic_mask(), unclamp_brightness, limit_values[2])
 
         if self.albedo_image.mode == 'RGBA':
-            alpha = self.albedo_image.split()[-1]
+            alpha_data = np.asarray(self.albedo_image.getchannel('A'))
+            corrected_data = np.dstack((corrected_data, alpha_data))
+
+        return Image.fromarray(corrected_data)
+
+    def range_corrected(self, image_data, limit_values, correct_range):
+        if not self.reuses_luminance():
+            return correct_range(image_data, limit_values)
+
+        # float64 like the reference, a float32 copy would change the rounding
+        tile_rows = self.tile_rows or INCREMENTAL_TILE_ROWS
+        luminance_data = self.intermediate(
+            "correct_luminance", (),
+            lambda: luminance_tiled(image_data, self.transfer, True, tile_rows, self.workers))
+
+        return correct_luminance_tiled(image_data, luminance_data, limit_values, tile_rows, self.transfer,
+                                       self.workers)
+
+    def range_statistics(self, image_data, limit_values, source, masks=False):
+        if not self.reuses_luminance():
+            return verify_statistics_tiled(image_data, limit_values, self.tile_rows, self.transfer, self.workers,
+                                           masks)
+
+        luminance_data = self.intermediate(
+            "verify_luminance", source,
+            lambda: luminance_tiled(image_data, self.transfer, False, self.tile_rows or INCREMENTAL_TILE_ROWS,
+                                    self.workers))
+        below = np.empty(luminance_data.shape, dtype=bool) if masks else None
+        above = np.empty(luminance_data.shape, dtype=bool) if masks else None
+
+        return luminance_statistics(image_data, luminance_data, limit_values, below, above), below, above
+
+    def reuses_luminance(self):
+        # keeping full-size linear RGB and luminance only pays off when the same set is re-evaluated,
+        # and only the reference kernel computes them separately
+        return self.incremental and self.kernel == "reference" and self.engine in ["dense", "auto"]
+
+    def intermediate(self, name, dependencies, compute):
+        # every intermediate is keyed by the parameters it depends on, including upstream ones,
+        # so a parameter change only recomputes the stages downstream of it
+        if not self.incremental:
+            return compute()
+
+        cached = self.intermediates.get(name)
+        if cached is not None and cached[0] == dependencies:
+            return cached[1]
+
+        value = compute()
+        self.intermediates[name] = (dependencies, value)
+        return value
+
+    def albedo_data(self):
+        return self.intermediate("albedo_data", (), lambda: np.asarray(self.albedo_image.convert("RGB")))
+
+    def options(self):
+        # the processing options the set was built with, as the batch passes them from the config
+        return dict(tile_rows=self.tile_rows, kernel=self.kernel, transfer=self.transfer, engine=self.engine,
+                    lut_size=self.lut_size, workers=self.workers)
+
+    def proxy(self, view_size=650):
+        # a downsampled copy of the set for live previews, it keeps its intermediates between parameter changes
+        if view_size not in self.proxies:
+            self.proxies[view_size] = PBRSet(*proxy_textures(*self.source_images, view_size=view_size),
+                                             kernel=self.kernel, transfer=self.transfer, engine=self.engine,
+                                             lut_size=self.lut_size, incremental=True, workers=self.workers)
+
+        return self.proxies[view_size]
+
+    def cache_key(self, *parameters):
+        if self.cache is None:
+            return None
+
+        # kernel, transfer and lut engines can differ from the reference by one level, so they are part of the key
+        processing = (self.kernel, self.transfer, self.engine, self.lut_size)
+        return self.cache.key(self.source_images, *parameters, processing)
+
+    def cached_result(self, cache_key):
+        if cache_key is None:
+            return None
+
+        return self.cache.get(cache_key)
+
+    def cache_result(self, cache_key, **result):
+        # results that were not produced are left out, a replay treats a missing entry as None
+        if cache_key is not None:
+            self.cache.put(cache_key, {name: np.asarray(value) for name, value in result.items() if value is not None})
+
+    def color_functions(self, image_data, *stages):
+        functions = [stage_function(stage, self.kernel, self.transfer, self.tile_rows, self.workers)
+                     for stage in stages]
+
+        # lattice tables interpolate, they only produce correction output and verification stays exact
+        if self.engine == "lut":
+            return [self.lut_function(stage) if stage in LUT_STAGES else function
+                    for stage, function in zip(stages, functions)]
+
+        if self.use_palette(image_data):
+            return [memoize_colors(function, image_data, self.albedo_palette) for function in functions]
+
+        return functions
+
+    def color_lut(self, stage, *args, size=None):
+        if stage in RANGE_STAGES:
+            args = (tuple(args[0][:2]),)
         else:
-            alpha = None
+            args = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
 
-        if alpha:
-            self.albedo_corrected.putalpha(alpha)
+        return stage_lut(stage, args, self.kernel, self.transfer, size or self.lut_size, self.workers)
 
-        if is_compensating and mode in ["metallic", "combined"]:
-            lightening_factor = ImageChops.subtract(self.albedo_corrected, self.albedo_image).convert("L")
-            enhancer = ImageEnhance.Contrast(lightening_factor)
-            lightening_factor = enhancer.enhance(coefficient ** 3.14)
+    def lut_function(self, stage):
+        def apply_lut(image_data, *args):
+            return apply_color_lut(image_data, self.color_lut(stage, *args))
 
-            darkening_factor = ImageChops.subtract(self.albedo_image, self.albedo_corrected).convert("L")
-            enhancer = ImageEnhance.Contrast(darkening_factor)
-            darkening_factor = enhancer.enhance(coefficient ** 3.14)
+        return apply_lut
 
-            roughness_compensated = ImageChops.subtract(self.roughness_image, lightening_factor.convert("RGB"))
-            roughness_compensated = ImageChops.add(roughness_compensated, darkening_factor.convert("RGB"))
+    def export_cube(self, path, mode, limit_values, size=33):
+        if mode not in CUBE_STAGES:
+            raise ValueError(f"{mode} mode depends on the metallic mask and cannot be exported as a single LUT")
 
-            self.roughness_corrected = roughness_compensated
+        lut = self.color_lut(CUBE_STAGES[mode], limit_values, size=size)
+        write_cube(path, lut, f"{mode} {limit_values[0]}-{limit_values[1]} {limit_values[2]}")
 
-    def verify_albedo(self, limit_values, mode):
-        self.albedo_verified = self.albedo_image.convert("RGB")
-        image_data = None
+    def use_palette(self, image_data):
+        # image_data is the albedo, its colors are counted once per set and the palette is kept for the stages
+        # applied to it
+        if self.palette_chosen is None:
+            pixels = image_data.shape[0] * image_data.shape[1]
+            self.palette_chosen = self.engine == "palette" or self.engine == "auto" and pixels >= PALETTE_MIN_PIXELS
 
-        if mode == "nonmetallic":
-            image_data = np.array(self.albedo_verified, dtype=np.float32)
+            if self.palette_chosen:
+                counted = color_keys(image_data)
+                if self.engine == "auto":
+                    self.palette_chosen = count_colors(image_data, counted) < PALETTE_RATIO_LIMIT * pixels
+                if self.palette_chosen:
+                    self.albedo_palette = find_palette(image_data, counted)
 
-        if mode == "metallic":
-            image_data = np.array(clamp_brightness(self.albedo_verified, limit_values[2]), dtype=np.float32)
+        return self.palette_chosen
 
-        if mode == "combined":
-            image_adjusted = clamp_brightness(self.albedo_verified, limit_values[2])
+    def metallic_mask(self):
+        return self.intermediate("metallic_mask", (), self.metallic_mask_data)
+
+    def metallic_mask_data(self):
+        return np.asarray(mask_image(self.metallic_image))
 
-            if self.metallic_image.mode != 'P':
-                metallic_mask = self.metallic_image.split()[0]
-            else:
-                metallic_mask = self.metallic_image
+    def verify_albedo(self, limit_values, mode, overlay=True, mask=None):
+        # mask is None or one of MASK_ENCODINGS, a compact classification the overlay can be rendered from later
+        cache_key = self.cache_key("verify", mode, limit_values)
+        cached = self.cached_result(cache_key)
+        self.verification = (mode, list(limit_values))
 
-            metallic_mask = metallic_mask.convert('L')
+        # entries cached without an overlay or mask only answer requests that do not need them
+        if cached is not None and "below" in cached and (not overlay or cached.get("albedo_verified") is not None) \
+                and (mask is None or "mask_shape" in cached):
+            if overlay:
+                self.albedo_verified = Image.fromarray(cached["albedo_verified"])
+            self.albedo_mask = mask_from_arrays(cached) if mask is not None else None
+            self.albedo_statistics = {name: cached[name].item() if cached[name].ndim == 0 else cached[name]
+                                      for name in VERIFY_STATISTICS}
+            return int(cached["mismatched_pixels"])
 
-            albedo = self.albedo_image.convert("RGB")
-            albedo.paste(image_adjusted, mask=metallic_mask)
-            image_data = np.array(albedo, dtype=np.float32)
+        self.albedo_verified = self.albedo_image.convert("RGB") if overlay else None
+        self.albedo_mask = None
+        self.albedo_statistics = None
+        image_data, source = self.verified_source(mode, limit_values)
 
         if image_data is not None:
-            verified_data = verify_range(image_data, limit_values)
-            self.albedo_verified = Image.fromarray(verified_data.astype('uint8'))
+            # mismatches are counted from the luminance masks, pure red or blue albedo is not a mismatch
+            statistics, below, above = self.range_statistics(image_data, limit_values, source,
+                                                             overlay or mask is not None)
+            mismatched_pixels = statistics["below"] + statistics["above"]
+            self.albedo_statistics = statistics
+
+            verified_data = None
+            if overlay:
+                verified_data = verification_overlay(image_data, below, above)
+                self.albedo_verified = Image.fromarray(verified_data)
 
-            mismatched_pixels = ((verified_data == [255, 0, 0]) | (verified_data == [0, 0, 255])).all(axis=2).sum()
+            mask_arrays = {}
+            if mask is not None:
+                self.albedo_mask = compact_mask(below, above, mask)
+                mask_arrays = self.albedo_mask.to_arrays()
+
+            self.cache_result(cache_key, albedo_verified=verified_data, mismatched_pixels=mismatched_pixels,
+                              **statistics, **mask_arrays)
             return mismatched_pixels
         else:
             return 0
 
+    def verified_source(self, mode, limit_values):
+        # the image the luminance limits are checked on, and the parameters it depends on
+        albedo_data = self.albedo_data()
+        clamp_brightness, = self.color_functions(albedo_data, "clamp")
+        source = (mode, limit_values[2]) if mode in ["metallic", "combined"] else (mode,)
+
+        if mode == "nonmetallic":
+            return albedo_data, source
+
+        if mode == "metallic":
+            return self.intermediate("albedo_clamped", source,
+                                     lambda: clamp_brightness(albedo_data, limit_values[2])), source
+
+        if mode == "combined":
+            return self.intermediate(
+                "albedo_clamped", source,
+                lambda: apply_by_mask(albedo_data, self.metallic_mask(), clamp_brightness, limit_values[2])), source
+
+        return None, source
+
+    def render_verification(self, view_size=None):
+        # paints the compact mask onto the checked image, at full size or onto the proxy for a view
+        if self.albedo_mask is None:
+            return None
+
+        pbr_set = self.proxy(view_size) if view_size else self
+        image_data, _ = pbr_set.verified_source(*self.verification)
+
+        return Image.fromarray(verification_overlay(image_data, *self.albedo_mask.masks(image_data.shape[:2])))
+
     def save(self, path, albedo_filename, roughness_filename):
         if self.albedo_corrected is not None:
             albedo_file_path = path + "/" + albedo_filename + "_corrected" + ".tga"
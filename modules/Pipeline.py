@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+
+from .Batch import BatchResult, texture_images, processing_options, save_pbr_set
+from .PBR import PBRSet
+from .Textures import TextureStore
+
+
+class StageStats:
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, busy, waiting):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.waiting += waiting
+
+    def utilization(self, elapsed):
+        return self.busy / max(elapsed * self.threads, 1e-9)
+
+
+def stage_report(stages, elapsed):
+    lines = []
+
+    # the stage closest to 100% busy is the bottleneck, the others spend their time blocked on the queues
+    for stats in stages:
+        lines.append(f"{stats.name:<8}{stats.threads:>3} threads {stats.items:>5} sets "
+                     f"{stats.utilization(elapsed):>6.0%} busy {stats.busy:>8.2f}s working "
+                     f"{stats.waiting:>8.2f}s blocked on the next stage")
+
+    bottleneck = max(stages, key=lambda stats: stats.utilization(elapsed))
+    lines.append(f"bottleneck: {bottleneck.name}")
+
+    return "\n".join(lines)
+
+
+def run_pipeline(texture_sets, cfg, task="correct", output_dir=None, io_threads=2, queue_size=2, callback=None):
+    # reading set N+1, computing set N and writing set N-1 overlap, bounded queues stop a fast
+    # stage from running ahead and holding every decoded texture in memory
+    start = time.perf_counter()
+    pending = queue.Queue()
+    decoded = queue.Queue(maxsize=queue_size)
+    computed = queue.Queue(maxsize=queue_size)
+    stages = [StageStats("decode", io_threads), StageStats("compute", 1), StageStats("encode", io_threads)]
+    decode_stats, compute_stats, encode_stats = stages
+    limit_values = [cfg.l_min, cfg.l_max, cfg.b_limit]
+    results = []
+    results_lock = threading.Lock()
+
+    for texture_set in texture_sets:
+        pending.put(texture_set)
+
+    def decode():
+        # each thread only keeps the set it decoded last, the queues hold the rest
+        store = TextureStore(cfg.texture_cache_directory or None, max_textures=3)
+
+        while True:
+            try:
+                texture_set = pending.get_nowait()
+            except queue.Empty:
+                decoded.put(None)
+                return
+
+            started = time.perf_counter()
+            result = BatchResult(texture_set, task)
+            images = None
+
+            try:
+                images = texture_images(texture_set, cfg, store)
+                result.pixels = images[0].width * images[0].height
+            except Exception as e:
+                result.error = str(e)
+
+            ready = time.perf_counter()
+            decoded.put((result, images, started))
+            decode_stats.record(ready - started, time.perf_counter() - ready)
+
+    def encode():
+        while True:
+            item = computed.get()
+            if item is None:
+                return
+
+            result, pbr_set, started = item
+            encoding = time.perf_counter()
+
+            try:
+                if pbr_set is not None and task == "correct":
+                    save_pbr_set(pbr_set, result.texture_set, output_dir)
+            except Exception as e:
+                result.error = str(e)
+
+            result.elapsed = time.perf_counter() - started
+            encode_stats.record(time.perf_counter() - encoding, 0.0)
+
+            with results_lock:
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+
+    decoders = [threading.Thread(target=decode, daemon=True) for _ in range(io_threads)]
+    encoders = [threading.Thread(target=encode, daemon=True) for _ in range(io_threads)]
+    for thread in decoders + encoders:
+        thread.start()
+
+    # compute runs on this thread, PBRSet parallelizes inside a texture through its row band workers
+    finished_decoders = 0
+    while finished_decoders < io_threads:
+        item = decoded.get()
+        if item is None:
+            finished_decoders += 1
+            continue
+
+        result, images, started = item
+        computing = time.perf_counter()
+        pbr_set = None
+
+        if images is not None:
+            try:
+                pbr_set = PBRSet(*images, **processing_options(cfg))
+                if task == "correct":
+                    pbr_set.correct_albedo(cfg.mode, limit_values, cfg.is_compensating, cfg.compensation_coefficient)
+                elif task == "verify":
+                    result.mismatched_pixels = int(pbr_set.verify_albedo(limit_values, cfg.mode, overlay=False))
+            except Exception as e:
+                result.error = str(e)
+                pbr_set = None
+
+        ready = time.perf_counter()
+        computed.put((result, pbr_set, started))
+        compute_stats.record(ready - computing, time.perf_counter() - ready)
+
+    for _ in encoders:
+        computed.put(None)
+    for thread in decoders + encoders:
+        thread.join()
+
+    return results, time.perf_counter() - start, stages
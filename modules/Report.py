@@ -0,0 +1,154 @@
+import copy
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from .Batch import processing_options, texture_images
+from .ImageProcessing import clamp_brightness_data, decode_luminance
+from .PBR import PBRSet
+from .Textures import TextureStore
+
+LUMINANCE_PERCENTILES = [1, 5, 50, 95, 99]
+
+REPORT_FIELDS = ["path", "finish_style", "mode", "checked", "pixels", "percent_correct", "below_min", "above_max"] + \
+                [f"luminance_p{percentile}" for percentile in LUMINANCE_PERCENTILES] + ["elapsed", "error"]
+
+
+def histogram_percentiles(histogram, percentiles=LUMINANCE_PERCENTILES):
+    cumulative = np.cumsum(histogram)
+    return [int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100)) for percentile in percentiles]
+
+
+def block_bounds(image_data, factor):
+    # per-channel minimum and maximum of every factor x factor block
+    rows = np.arange(0, image_data.shape[0], factor)
+    columns = np.arange(0, image_data.shape[1], factor)
+
+    return (np.minimum.reduceat(np.minimum.reduceat(image_data, rows, axis=0), columns, axis=1),
+            np.maximum.reduceat(np.maximum.reduceat(image_data, rows, axis=0), columns, axis=1))
+
+
+def within_limits(image, cfg, prepass_size):
+    # luminance grows with every channel and so does the brightness clamp, so the luminance of the block-wise channel
+    # minimum and maximum bounds every texel of a block, the combined mode blends between both; when the bounds are
+    # within the limits every texel is, anything else gets a full check
+    image_data = np.asarray(image.convert("RGB"))
+    low, high = block_bounds(image_data, -(-max(image_data.shape[:2]) // prepass_size))
+    bounds = []
+
+    if cfg.mode in ["nonmetallic", "combined"]:
+        bounds.append((low, high))
+    if cfg.mode in ["metallic", "combined"]:
+        bounds.append((clamp_brightness_data(low, cfg.b_limit), clamp_brightness_data(high, cfg.b_limit)))
+
+    for low, high in bounds:
+        if decode_luminance(low.astype(np.float32), cfg.transfer)[1].min() < cfg.l_min or \
+                decode_luminance(high.astype(np.float32), cfg.transfer)[1].max() > cfg.l_max:
+            return False
+
+    return True
+
+
+def verify_statistics(images, cfg):
+    pbr_set = PBRSet(*images, **processing_options(cfg))
+    pbr_set.verify_albedo([cfg.l_min, cfg.l_max, cfg.b_limit], cfg.mode, overlay=False)
+
+    return pbr_set.albedo_statistics
+
+
+def report_texture_set(job):
+    texture_set, cfg, prepass_size = job
+    record = {"path": texture_set.albedo_path, "finish_style": cfg.finish_style, "mode": cfg.mode}
+    start = time.perf_counter()
+
+    try:
+        store = TextureStore(cfg.texture_cache_directory or None, max_textures=3)
+        images = texture_images(texture_set, cfg, store)
+        pixels = images[0].width * images[0].height
+        record["pixels"] = pixels
+
+        # a set within its bounds has no texel out of range, its luminance distribution was never measured
+        if prepass_size and max(images[0].size) > prepass_size and within_limits(images[0], cfg, prepass_size):
+            record.update(checked="bounds", below_min=0, above_max=0, percent_correct=100.0)
+        else:
+            statistics = verify_statistics(images, cfg)
+            record.update(checked="full", below_min=statistics["below"], above_max=statistics["above"])
+            record["percent_correct"] = round(100 - (statistics["below"] + statistics["above"]) / pixels * 100, 2)
+
+            for percentile, level in zip(LUMINANCE_PERCENTILES, histogram_percentiles(statistics["histogram"])):
+                record[f"luminance_p{percentile}"] = level
+
+    except Exception as e:
+        record["error"] = str(e)
+
+    record["elapsed"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+class ReportWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='')
+        self.writer = None
+
+        if path.lower().endswith(".csv"):
+            self.writer = csv.DictWriter(self.file, REPORT_FIELDS)
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps({field: record.get(field) for field in REPORT_FIELDS}) + "\n")
+
+        # every record is on disk as soon as it is written, an interrupted scan keeps its partial report
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_report(texture_sets, cfg, report_path, workers=None, prepass_size=0, callback=None):
+    # records are written as they arrive and never kept, memory stays flat however large the library is
+    start = time.perf_counter()
+    cfg = copy.copy(cfg)
+    # verification never reads roughness, and the process pool already occupies the cores
+    cfg.is_compensating = False
+    cfg.threads = 1
+    jobs = ((texture_set, cfg, prepass_size) for texture_set in texture_sets)
+    summary = {"sets": 0, "bounds": 0, "full": 0, "failing": 0, "errors": 0}
+
+    def record_result(record):
+        writer.write(record)
+        summary["sets"] += 1
+
+        if record.get("error") is not None:
+            summary["errors"] += 1
+        else:
+            summary[record["checked"]] += 1
+            summary["failing"] += record["percent_correct"] < 100
+
+        if callback is not None:
+            callback(record)
+
+    with ReportWriter(report_path) as writer:
+        if workers == 1:
+            for job in jobs:
+                record_result(report_texture_set(job))
+        else:
+            with Pool(workers or os.cpu_count() or 1) as pool:
+                for record in pool.imap_unordered(report_texture_set, jobs):
+                    record_result(record)
+
+    summary["elapsed"] = time.perf_counter() - start
+    return summary
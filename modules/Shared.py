@@ -0,0 +1,188 @@
+import os
+from collections import OrderedDict
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+from .PBR import PBRSet, mask_image
+
+# released blocks the parent keeps for reuse, past this the least recently released ones are unlinked
+SHARED_POOL_BYTES = 512 * 1024 * 1024
+
+# blocks attached by this worker process, kept open because the parent reuses them for later jobs
+attached_blocks = OrderedDict()
+
+
+def attach(descriptor):
+    name, shape, dtype = descriptor
+
+    block = attached_blocks.pop(name, None)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+    attached_blocks[name] = block
+
+    return np.ndarray(shape, dtype, buffer=block.buf)
+
+
+def detach_idle(keep, max_bytes=SHARED_POOL_BYTES):
+    # an unlinked block is only freed once every worker has closed it, so workers keep the least recently used
+    # blocks within the same cap as the parent and close the rest, except the blocks of the current job
+    for name in list(attached_blocks):
+        if sum(block.size for block in attached_blocks.values()) <= max_bytes:
+            break
+
+        if name not in keep:
+            try:
+                attached_blocks[name].close()
+            except BufferError:
+                continue
+            del attached_blocks[name]
+
+
+class SharedBuffers:
+    def __init__(self, max_free_bytes=SHARED_POOL_BYTES):
+        self.max_free_bytes = max_free_bytes
+        self.blocks = {}
+        # released blocks in the order they were released, handed out again to the next array of the same size
+        self.free = OrderedDict()
+
+    def empty(self, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = next((block for block in self.free.values() if block.size == size), None)
+
+        if block is not None:
+            del self.free[block.name]
+        else:
+            block = shared_memory.SharedMemory(create=True, size=size)
+            self.blocks[block.name] = block
+
+        return block.name, tuple(shape), dtype.str
+
+    def share(self, image_data):
+        descriptor = self.empty(image_data.shape, image_data.dtype)
+        np.copyto(self.array(descriptor), image_data)
+
+        return descriptor
+
+    def array(self, descriptor):
+        name, shape, dtype = descriptor
+        return np.ndarray(shape, dtype, buffer=self.blocks[name].buf)
+
+    def release(self, descriptor):
+        if descriptor is not None:
+            block = self.blocks[descriptor[0]]
+            self.free[block.name] = block
+
+            # a batch of differently sized sets would otherwise keep a block of every size in /dev/shm
+            while sum(block.size for block in self.free.values()) > self.max_free_bytes:
+                _, block = self.free.popitem(last=False)
+                self.unlink(block)
+
+    def unlink(self, block):
+        del self.blocks[block.name]
+        block.close()
+        block.unlink()
+
+    def close(self):
+        for block in list(self.blocks.values()):
+            self.unlink(block)
+
+        self.free.clear()
+
+
+def compute_shared(job):
+    task, inputs, outputs, parameters, options, max_free_bytes = job
+    detach_idle([descriptor[0] for descriptor in inputs + list(outputs.values()) if descriptor is not None],
+                max_free_bytes)
+    albedo, metallic, roughness = [Image.fromarray(attach(descriptor)) if descriptor is not None else None
+                                   for descriptor in inputs]
+    pbr_set = PBRSet(albedo, metallic, roughness, **options)
+    mode, limit_values, is_compensating, coefficient = parameters
+
+    if task == "correct":
+        pbr_set.correct_albedo(mode, limit_values, is_compensating, coefficient)
+        np.copyto(attach(outputs["albedo"]), np.asarray(pbr_set.albedo_corrected))
+
+        if pbr_set.roughness_corrected is not None:
+            np.copyto(attach(outputs["roughness"]), np.asarray(pbr_set.roughness_corrected))
+            return {"roughness_corrected": True}
+
+        return {"roughness_corrected": False}
+
+    mismatched_pixels = pbr_set.verify_albedo(limit_values, mode, overlay="albedo" in outputs)
+    if "albedo" in outputs:
+        np.copyto(attach(outputs["albedo"]), np.asarray(pbr_set.albedo_verified))
+
+    return {"mismatched_pixels": int(mismatched_pixels)}
+
+
+class SharedJob:
+    def __init__(self, task, inputs, outputs, result):
+        self.task = task
+        self.inputs = inputs
+        self.outputs = outputs
+        self.result = result
+
+
+class SharedExecutor:
+    def __init__(self, processes=None, max_free_bytes=SHARED_POOL_BYTES, **options):
+        # options are passed on to every PBRSet the workers build
+        self.options = options
+        self.processes = processes or os.cpu_count() or 1
+        self.buffers = SharedBuffers(max_free_bytes)
+
+        # workers have to share this process' resource tracker, one of their own would unlink
+        # the blocks they attached to as soon as the pool shuts down
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+        self.pool = Pool(self.processes)
+
+    def submit(self, task, albedo_image, metallic_image=None, roughness_image=None, mode="combined",
+               limit_values=(8, 235, 52), is_compensating=False, coefficient=1.0, overlay=True):
+        # inputs are normalized to the modes PBRSet would read them as, so workers never convert full images
+        if albedo_image.mode not in ["RGB", "RGBA"]:
+            albedo_image = albedo_image.convert("RGB")
+        if metallic_image is not None:
+            metallic_image = mask_image(metallic_image)
+        if roughness_image is not None:
+            roughness_image = roughness_image.convert("RGB")
+
+        albedo_data = np.asarray(albedo_image)
+        inputs = [self.buffers.share(np.asarray(image)) if image is not None else None
+                  for image in (albedo_image, metallic_image, roughness_image)]
+
+        # corrected albedo keeps the alpha channel, verified albedo and roughness are RGB
+        rgb_shape = albedo_data.shape[:2] + (3,)
+        outputs = {}
+        if task == "correct" or overlay:
+            outputs["albedo"] = self.buffers.empty(albedo_data.shape if task == "correct" else rgb_shape)
+        if task == "correct" and roughness_image is not None:
+            outputs["roughness"] = self.buffers.empty(rgb_shape)
+
+        parameters = (mode, list(limit_values), is_compensating, coefficient)
+        job = (task, inputs, outputs, parameters, self.options, self.buffers.max_free_bytes)
+        result = self.pool.apply_async(compute_shared, (job,))
+
+        return SharedJob(task, inputs, outputs, result)
+
+    def wait(self, job):
+        # outputs stay valid until release, the caller copies or saves them first
+        summary = job.result.get()
+        return {name: self.buffers.array(descriptor) for name, descriptor in job.outputs.items()}, summary
+
+    def release(self, job):
+        for descriptor in job.inputs + list(job.outputs.values()):
+            self.buffers.release(descriptor)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.buffers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
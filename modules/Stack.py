@@ -0,0 +1,161 @@
+import numpy as np
+from PIL import Image
+
+from .Backends import backend_kernel
+from .ImageProcessing import apply_by_mask, apply_color_lut, compensate_roughness, for_row_bands, \
+    verification_overlay, verify_statistics_stack
+from .Memory import JOB_OVERHEAD_BYTES, calibrate_memory_model, estimate_peak_memory
+from .Verification import compact_mask
+
+# every stage runs on one band of the stack after the other, so a band stays in cache from decoding to the result
+STACK_TILE_ROWS = 128
+
+# baking the exact 256^3 table costs about as much as correcting 16.7M pixels directly and a lookup about a fifth
+# of a direct correction, so with auto the table is used once a stack of one shape holds twice as many pixels
+STACK_LUT_PIXELS = 2 * 256 ** 3
+
+
+def stack_key(pbr_set, mode, is_compensating=False):
+    # sets only stack when every array they contribute has the same shape
+    return (pbr_set.albedo_image.size, pbr_set.albedo_image.mode,
+            mode == "combined" and pbr_set.metallic_image is not None,
+            is_compensating and pbr_set.roughness_image is not None)
+
+
+def stack_chunks(pbr_sets, task, mode, is_compensating=False, memory_limit_mb=1024):
+    # same-shaped sets in chunks whose modeled peak fits the limit, at least one set per chunk;
+    # the model is calibrated with the options of the first set, the ones the whole stack runs with
+    if not pbr_sets:
+        return
+
+    model = calibrate_memory_model(tuple(sorted(pbr_sets[0].options().items())))
+    groups = {}
+
+    for pbr_set in pbr_sets:
+        groups.setdefault(stack_key(pbr_set, mode, is_compensating), []).append(pbr_set)
+
+    for group in groups.values():
+        set_bytes = estimate_peak_memory(group[0].size(), task, mode, is_compensating, model) - JOB_OVERHEAD_BYTES
+        chunk_size = max(1, memory_limit_mb * 1024 * 1024 // max(set_bytes, 1))
+
+        for start in range(0, len(group), chunk_size):
+            yield group[start:start + chunk_size], len(group) * group[0].size()
+
+
+def stacked(arrays):
+    # an (N, H, W, C) stack seen as one (N * H, W, C) image, every stage below is per pixel
+    stack = np.stack(arrays)
+    return stack.reshape((-1,) + stack.shape[2:])
+
+
+def stack_lut(pbr_set, stage, limit_values, pixels):
+    # the palette engine counts colors per texture, a stack only chooses between the table and the kernels
+    if pbr_set.engine == "lut":
+        return pbr_set.color_lut(stage, limit_values)
+    if pbr_set.engine == "auto" and pixels >= STACK_LUT_PIXELS:
+        return pbr_set.color_lut(stage, limit_values, size=256)
+
+    return None
+
+
+def correct_stack(pbr_sets, mode, limit_values, is_compensating=False, coefficient=1.0, memory_limit_mb=1024):
+    # the processing options of the first set apply to the whole stack
+    compensating = is_compensating and mode in ["metallic", "combined"]
+
+    for chunk, pixels in stack_chunks(pbr_sets, "correct", mode, compensating, memory_limit_mb):
+        first = chunk[0]
+        height = first.albedo_image.height
+        correct_range = backend_kernel(first.kernel, "correct_range")
+        unclamp_brightness = backend_kernel(first.kernel, "unclamp")
+        compensation_factors = backend_kernel(first.kernel, "compensation")
+        # the metallic table includes the unclamp, combined mode unclamps only under the mask
+        lut = stack_lut(first, "metallic" if mode == "metallic" else "correct", limit_values, pixels)
+
+        albedo_data = stacked([pbr_set.albedo_data() for pbr_set in chunk])
+        mask_data = stacked([pbr_set.metallic_mask() for pbr_set in chunk]) if mode == "combined" else None
+        corrected_data = np.empty(albedo_data.shape, dtype=np.uint8)
+        lightening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8) if compensating else None
+        darkening_data = np.empty(albedo_data.shape[:2], dtype=np.uint8) if compensating else None
+
+        def correct(band):
+            if lut is not None:
+                band_data = corrected_data[band] = apply_color_lut(albedo_data[band], lut)
+            else:
+                band_data = correct_range(albedo_data[band], limit_values, out=corrected_data[band],
+                                          transfer=first.transfer)
+
+            if mode == "metallic" and lut is None:
+                corrected_data[band] = unclamp_brightness(band_data, limit_values[2])
+
+            if mode == "combined":
+                corrected_data[band] = apply_by_mask(band_data, mask_data[band], unclamp_brightness, limit_values[2])
+
+            if compensating:
+                lightening_data[band], darkening_data[band] = compensation_factors(albedo_data[band],
+                                                                                   corrected_data[band], None)
+
+        for_row_bands(correct, height, first.tile_rows or STACK_TILE_ROWS, first.workers, len(chunk))
+
+        if compensating:
+            roughness_data = stacked([np.asarray(pbr_set.roughness_image.convert("RGB")) for pbr_set in chunk])
+
+        for index, pbr_set in enumerate(chunk):
+            rows = slice(index * height, (index + 1) * height)
+            image_data = corrected_data[rows]
+
+            if pbr_set.albedo_image.mode == 'RGBA':
+                image_data = np.dstack((image_data, np.asarray(pbr_set.albedo_image.getchannel('A'))))
+
+            pbr_set.albedo_corrected = Image.fromarray(image_data)
+            pbr_set.roughness_corrected = None
+
+            # the contrast of the compensation is relative to the mean of each texture, so it runs per set
+            if compensating:
+                pbr_set.roughness_corrected = Image.fromarray(
+                    compensate_roughness(roughness_data[rows], lightening_data[rows], darkening_data[rows],
+                                         coefficient, workers=first.workers))
+
+
+def verify_stack(pbr_sets, limit_values, mode, overlay=False, mask=None, memory_limit_mb=1024):
+    mismatched_pixels = {}
+
+    for chunk, _ in stack_chunks(pbr_sets, "verify", mode, False, memory_limit_mb):
+        first = chunk[0]
+        clamp_brightness = backend_kernel(first.kernel, "clamp")
+        albedo_data = stacked([pbr_set.albedo_data() for pbr_set in chunk])
+        mask_data = stacked([pbr_set.metallic_mask() for pbr_set in chunk]) if mode == "combined" else None
+        # the overlay is painted onto the clamped albedo, so it is only kept when an overlay is wanted
+        checked_data = np.empty(albedo_data.shape, dtype=np.uint8) if overlay else None
+
+        def prepare(band, band_data):
+            if mode == "metallic":
+                band_data = clamp_brightness(band_data, limit_values[2])
+
+            if mode == "combined":
+                band_data = apply_by_mask(band_data, mask_data[band], clamp_brightness, limit_values[2])
+
+            if overlay:
+                checked_data[band] = band_data
+            return band_data
+
+        image_stack = albedo_data.reshape((len(chunk), -1) + albedo_data.shape[1:])
+        statistics, below, above = verify_statistics_stack(image_stack, limit_values,
+                                                           first.tile_rows or STACK_TILE_ROWS, first.transfer,
+                                                           first.workers, overlay or mask is not None, prepare)
+
+        for index, pbr_set in enumerate(chunk):
+            pbr_set.verification = (mode, list(limit_values))
+            pbr_set.albedo_statistics = statistics[index]
+            pbr_set.albedo_verified = None
+            pbr_set.albedo_mask = None
+
+            if overlay:
+                checked_stack = checked_data.reshape(image_stack.shape)
+                pbr_set.albedo_verified = Image.fromarray(verification_overlay(checked_stack[index], below[index],
+                                                                               above[index]))
+            if mask is not None:
+                pbr_set.albedo_mask = compact_mask(below[index], above[index], mask)
+
+            mismatched_pixels[id(pbr_set)] = statistics[index]["below"] + statistics[index]["above"]
+
+    return [mismatched_pixels[id(pbr_set)] for pbr_set in pbr_sets]
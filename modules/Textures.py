@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# modes that map directly onto a uint8 array, anything else is converted when decoded
+ARRAY_MODES = ["L", "P", "RGB", "RGBA"]
+
+
+def decode_texture(path):
+    with Image.open(path) as image:
+        if image.mode not in ARRAY_MODES:
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        palette = image.getpalette() if image.mode == "P" else None
+        return np.asarray(image), image.mode, palette
+
+
+def texture_image(image_data, mode, palette=None):
+    if mode != "P":
+        return Image.fromarray(image_data)
+
+    image = Image.frombuffer("P", image_data.shape[::-1], np.ascontiguousarray(image_data), "raw", "P", 0, 1)
+    image.putpalette(palette)
+    return image
+
+
+class TextureStore:
+    def __init__(self, directory=None, max_textures=8):
+        self.directory = directory
+        self.max_textures = max_textures
+        self.textures = OrderedDict()
+        # resized variants by the id of their source image, dropped when the source is garbage collected
+        self.variants = {}
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def open(self, path, mode=None):
+        key = self.key(path)
+        image = self.textures.get(key)
+
+        if image is None:
+            image = texture_image(*self.decoded(key))
+            self.textures[key] = image
+
+            while len(self.textures) > self.max_textures:
+                self.textures.popitem(last=False)
+
+        self.textures.move_to_end(key)
+
+        if mode is None or mode == image.mode:
+            return image
+
+        return self.variant(image, ("convert", mode), lambda: image.convert(mode))
+
+    def array(self, path, mode=None):
+        return np.asarray(self.open(path, mode))
+
+    def resize(self, image, size):
+        if image.size == tuple(size):
+            return image
+
+        return self.variant(image, ("resize", tuple(size)), lambda: image.resize(size))
+
+    def variant(self, image, key, create):
+        variants = self.variants.get(id(image))
+
+        if variants is None:
+            variants = self.variants[id(image)] = {}
+            weakref.finalize(image, self.variants.pop, id(image), None)
+
+        if key not in variants:
+            variants[key] = create()
+
+        return variants[key]
+
+    def decoded(self, key):
+        if not self.directory:
+            return decode_texture(key[0])
+
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        data_path = os.path.join(self.directory, digest + ".npy")
+        meta_path = os.path.join(self.directory, digest + ".json")
+
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            # mapped read-only, pages are only read from disk when the pixels are touched
+            return np.load(data_path, mmap_mode="r"), meta["mode"], meta["palette"]
+        except Exception:
+            pass
+
+        image_data, mode, palette = decode_texture(key[0])
+
+        # pixels first, the metadata file marks the entry as complete
+        temporary_path = data_path + f".{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as data_file:
+            np.save(data_file, image_data)
+        os.replace(temporary_path, data_path)
+
+        temporary_path = meta_path + f".{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as meta_file:
+            json.dump({"path": key[0], "mode": mode, "palette": palette}, meta_file)
+        os.replace(temporary_path, meta_path)
+
+        return image_data, mode, palette
@@ -0,0 +1,129 @@
+import numpy as np
+
+# two bits per texel, the overlay paints dark texels blue and bright ones red
+VERIFIED_OK = 0
+VERIFIED_DARK = 1
+VERIFIED_BRIGHT = 2
+
+MASK_ENCODINGS = ["packed", "rle"]
+
+
+def classify(below, above):
+    classes = below.astype(np.uint8)
+    classes[above] = VERIFIED_BRIGHT
+
+    return classes
+
+
+def pack_classes(classes):
+    flat = classes.ravel()
+    quads = np.zeros(-(-flat.size // 4) * 4, dtype=np.uint8)
+    quads[:flat.size] = flat
+    quads = quads.reshape(-1, 4)
+
+    return quads[:, 0] | quads[:, 1] << 2 | quads[:, 2] << 4 | quads[:, 3] << 6
+
+
+def unpack_classes(packed, shape):
+    quads = np.empty((packed.size, 4), dtype=np.uint8)
+    for index in range(4):
+        np.bitwise_and(packed >> 2 * index, 3, out=quads[:, index])
+
+    return quads.ravel()[:shape[0] * shape[1]].reshape(shape)
+
+
+def encode_runs(classes):
+    flat = classes.ravel()
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+
+    return flat[starts], lengths
+
+
+def decode_runs(values, lengths, shape):
+    return np.repeat(values, lengths).reshape(shape)
+
+
+def block_any(mask_data, shape):
+    # a reduced texel is set when any texel of its block is, isolated failures stay visible in small views
+    rows = np.arange(shape[0]) * mask_data.shape[0] // shape[0]
+    columns = np.arange(shape[1]) * mask_data.shape[1] // shape[1]
+
+    return np.logical_or.reduceat(np.logical_or.reduceat(mask_data, rows, axis=0), columns, axis=1)
+
+
+class VerificationMask:
+    def __init__(self, shape, encoding="packed", arrays=None):
+        if encoding not in MASK_ENCODINGS:
+            raise ValueError(f"unknown mask encoding {encoding}, expected one of {', '.join(MASK_ENCODINGS)}")
+
+        self.shape = tuple(int(size) for size in shape)
+        self.encoding = encoding
+        self.arrays = arrays or {}
+
+    def classes(self):
+        if self.encoding == "rle":
+            return decode_runs(self.arrays["values"], self.arrays["lengths"], self.shape)
+
+        return unpack_classes(self.arrays["packed"], self.shape)
+
+    def counts(self):
+        if self.encoding == "rle":
+            values, lengths = self.arrays["values"], self.arrays["lengths"]
+            return {"dark": int(lengths[values == VERIFIED_DARK].sum()),
+                    "bright": int(lengths[values == VERIFIED_BRIGHT].sum())}
+
+        classes = self.classes()
+        return {"dark": int(np.count_nonzero(classes == VERIFIED_DARK)),
+                "bright": int(np.count_nonzero(classes == VERIFIED_BRIGHT))}
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def masks(self, shape=None):
+        classes = self.classes()
+        below = classes == VERIFIED_DARK
+        above = classes == VERIFIED_BRIGHT
+
+        if shape is None or tuple(shape) == self.shape:
+            return below, above
+
+        # bright wins where a block holds both, as it is painted last in the full size overlay
+        above = block_any(above, shape)
+        return block_any(below, shape) & ~above, above
+
+    def to_arrays(self):
+        arrays = {"mask_" + name: array for name, array in self.arrays.items()}
+        arrays["mask_shape"] = np.array(self.shape)
+        arrays["mask_encoding"] = np.array(MASK_ENCODINGS.index(self.encoding))
+
+        return arrays
+
+    def save(self, path):
+        with open(path, 'wb') as mask_file:
+            np.savez(mask_file, **self.to_arrays())
+
+
+def compact_mask(below, above, encoding="packed"):
+    classes = classify(below, above)
+
+    if encoding == "rle":
+        values, lengths = encode_runs(classes)
+        return VerificationMask(classes.shape, encoding, {"values": values, "lengths": lengths})
+
+    return VerificationMask(classes.shape, encoding, {"packed": pack_classes(classes)})
+
+
+def mask_from_arrays(arrays):
+    if "mask_shape" not in arrays:
+        return None
+
+    encoding = MASK_ENCODINGS[int(arrays["mask_encoding"])]
+    names = ["values", "lengths"] if encoding == "rle" else ["packed"]
+
+    return VerificationMask(arrays["mask_shape"], encoding, {name: arrays["mask_" + name] for name in names})
+
+
+def load_mask(path):
+    with np.load(path) as stored:
+        return mask_from_arrays({name: stored[name] for name in stored.files})
@@ -0,0 +1,266 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from .Batch import IMAGE_EXTENSIONS, BatchResult, TextureSet, compile_patterns, find_texture_sets, group_textures, \
+    processing_options, save_pbr_set, split_texture_name, texture_images
+from .Manifest import BuildManifest
+from .PBR import PBRSet
+from .Textures import TextureStore
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# wd, mask, cookie and name length, followed by the padded name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def is_texture_file(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+class PollingWatcher:
+    def __init__(self, directory):
+        self.directory = directory
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if is_texture_file(filename):
+                    path = os.path.join(directory, filename)
+                    state[path] = file_state(path)
+
+        return state
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        state = self.snapshot()
+        changed = {path for path, stat in state.items() if self.state.get(path) != stat}
+        changed.update(set(self.state) - set(state))
+        self.state = state
+
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    def __init__(self, directory):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+
+        self.directories = {}
+        for subdirectory, _, _ in os.walk(directory):
+            self.add(subdirectory)
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    def changes(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+
+                if wd not in self.directories:
+                    continue
+                path = os.path.join(self.directories[wd], name)
+
+                if not mask & IN_ISDIR:
+                    if is_texture_file(path):
+                        changed.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # files can land in a new directory before its watch exists
+                    for subdirectory, _, filenames in os.walk(path):
+                        self.add(subdirectory)
+                        changed.update(os.path.join(subdirectory, filename) for filename in filenames
+                                       if is_texture_file(filename))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(directory, use_inotify=True):
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher(directory)
+
+
+class Debouncer:
+    def __init__(self, settle):
+        self.settle = settle
+        # path to its last seen stat and when that stat was first seen
+        self.pending = {}
+
+    def add(self, paths, now):
+        for path in paths:
+            self.pending[path] = (file_state(path), now)
+
+    def ready(self, now):
+        # painting tools write large textures in several chunks, a file is only used once its
+        # size and mtime stayed the same for the whole settle time
+        ready = []
+
+        for path, (state, changed_at) in list(self.pending.items()):
+            current = file_state(path)
+
+            if current != state:
+                self.pending[path] = (current, now)
+            elif now - changed_at >= self.settle:
+                ready.append(path)
+                del self.pending[path]
+
+        return ready
+
+    def timeout(self, now, interval):
+        if not self.pending:
+            return interval
+
+        settles_at = min(changed_at for _, changed_at in self.pending.values()) + self.settle
+        return min(interval, max(settles_at - now, 0.05))
+
+
+class WatchDaemon:
+    def __init__(self, directory, cfg, task="correct", output_dir=None, interval=1.0, settle=2.0, use_inotify=True,
+                 callback=None):
+        self.directory = directory
+        self.cfg = cfg
+        self.task = task
+        self.output_dir = output_dir
+        self.interval = interval
+        self.callback = callback
+        self.patterns = compile_patterns(cfg.texture_patterns)
+        # decoded textures are keyed by path, mtime and size, so the maps an export did not touch are reused
+        self.store = TextureStore(cfg.texture_cache_directory or None, max_textures=24)
+        self.manifest = BuildManifest(cfg, output_dir) if task == "correct" else None
+        self.debouncer = Debouncer(settle)
+        self.watcher = create_watcher(directory, use_inotify)
+
+    def affected_sets(self, paths):
+        texture_sets = {}
+
+        for path in paths:
+            base_name, texture_type = split_texture_name(path, self.patterns)
+            if texture_type is None:
+                continue
+
+            directory = os.path.dirname(path)
+            if (directory, base_name) in texture_sets or not os.path.isdir(directory):
+                continue
+
+            textures = group_textures(directory, os.listdir(directory), self.patterns).get(base_name, {})
+            if "albedo" in textures:
+                texture_sets[(directory, base_name)] = TextureSet(textures["albedo"], textures.get("metallic"),
+                                                                  textures.get("roughness"))
+
+        return list(texture_sets.values())
+
+    def process(self, texture_set):
+        result = BatchResult(texture_set, self.task)
+        start = time.perf_counter()
+        limit_values = [self.cfg.l_min, self.cfg.l_max, self.cfg.b_limit]
+
+        try:
+            pbr_set = PBRSet(*texture_images(texture_set, self.cfg, self.store), **processing_options(self.cfg))
+            result.pixels = pbr_set.size()
+
+            if self.task == "correct":
+                pbr_set.correct_albedo(self.cfg.mode, limit_values, self.cfg.is_compensating,
+                                       self.cfg.compensation_coefficient)
+                save_pbr_set(pbr_set, texture_set, self.output_dir)
+                self.manifest.record(texture_set)
+                self.manifest.save()
+
+            elif self.task == "verify":
+                result.mismatched_pixels = int(pbr_set.verify_albedo(limit_values, self.cfg.mode, overlay=False))
+
+        except Exception as e:
+            result.error = str(e)
+
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def report(self, result, written_at=None):
+        # latency runs from the last write of a changed input to the finished output
+        latency = time.time() - written_at if written_at is not None else None
+        if self.callback is not None:
+            self.callback(result, latency)
+
+    def catch_up(self):
+        texture_sets = find_texture_sets([self.directory], self.cfg.texture_patterns)
+        if self.manifest is not None:
+            texture_sets = self.manifest.stale(texture_sets)
+
+        for texture_set in texture_sets:
+            self.report(self.process(texture_set))
+
+        return len(texture_sets)
+
+    def step(self):
+        changed = self.watcher.changes(self.debouncer.timeout(time.monotonic(), self.interval))
+        self.debouncer.add(changed, time.monotonic())
+        ready = self.debouncer.ready(time.monotonic())
+
+        for texture_set in self.affected_sets(ready):
+            inputs = [texture_set.albedo_path, texture_set.metallic_path, texture_set.roughness_path]
+            # an export writes all maps of a set, it runs once the last of them has settled
+            if any(path in self.debouncer.pending for path in inputs):
+                continue
+
+            states = [file_state(path) for path in inputs if path is not None]
+            write_times = [state[1] for state in states if state is not None]
+            self.report(self.process(texture_set), max(write_times) / 1e9 if write_times else None)
+
+        return len(ready)
+
+    def run(self):
+        try:
+            while True:
+                self.step()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
@@ -0,0 +1,30 @@
+import json
+
+import numpy as np
+import pytest
+
+from modules.Backends import BACKEND_TOLERANCE, BACKENDS, calibrate_backends, check_backend
+from modules.ImageProcessing import TRANSFER_FUNCTIONS
+
+
+@pytest.mark.parametrize("transfer", list(TRANSFER_FUNCTIONS))
+@pytest.mark.parametrize("kernel", list(BACKENDS))
+def test_backend_matches_reference(kernel, transfer):
+    assert max(check_backend(kernel, transfer).values()) <= BACKEND_TOLERANCE
+
+
+def test_rejected_backend_is_reported(tmp_path, monkeypatch):
+    def correct_range_off_by_two(image_data, limit_values, out=None, transfer="exact"):
+        return np.minimum(BACKENDS["reference"]["correct_range"](image_data, limit_values, transfer=transfer), 253) + 2
+
+    monkeypatch.setitem(BACKENDS, "broken", dict(BACKENDS["reference"], correct_range=correct_range_off_by_two))
+    path = str(tmp_path / "backends.json")
+
+    with pytest.warns(UserWarning, match="broken kernel rejected"):
+        backend = calibrate_backends.__wrapped__("exact", path)
+
+    with open(path) as calibration_file:
+        calibration, = json.load(calibration_file).values()
+
+    assert backend != "broken"
+    assert "correct_range by 2" in calibration["rejected"]["broken"]
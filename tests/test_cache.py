@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.Batch import find_texture_sets, run_batch, summarize
+from modules.Cache import ResultCache
+from modules.Config import CFG
+from modules.PBR import PBRSet
+
+LIMIT_VALUES = [8, 235, 52]
+
+
+@pytest.mark.parametrize("mode, is_compensating", [("nonmetallic", False), ("metallic", False), ("metallic", True)])
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_correct_twice_through_cache(tmp_path, mode, is_compensating, on_disk):
+    rng = np.random.default_rng(0)
+    albedo = Image.fromarray(rng.integers(0, 256, (32, 24, 3), dtype=np.uint8))
+    roughness = Image.fromarray(rng.integers(0, 256, (32, 24, 3), dtype=np.uint8))
+    # without memory the second correct is answered from the disk tier
+    cache = ResultCache(0 if on_disk else 512 * 1024 * 1024, str(tmp_path) if on_disk else None)
+    results = []
+
+    for _ in range(2):
+        pbr_set = PBRSet(albedo, None, roughness, cache=cache)
+        pbr_set.correct_albedo(mode, LIMIT_VALUES, is_compensating)
+        results.append(pbr_set)
+
+    assert cache.hits + cache.disk_hits == 1
+    assert np.array_equal(np.asarray(results[0].albedo_corrected), np.asarray(results[1].albedo_corrected))
+    assert (results[1].roughness_corrected is None) == (results[0].roughness_corrected is None)
+
+
+def test_batch_reports_cache_lookups(tmp_path):
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (32, 24, 3), dtype=np.uint8)).save(tmp_path / "set_albedo.tga")
+    cfg = CFG(str(tmp_path / "missing.cfg"))
+    cfg.mode = "nonmetallic"
+    cfg.cache_directory = str(tmp_path / "cache")
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+
+    for hits in [0, 1]:
+        results, elapsed = run_batch(find_texture_sets([str(tmp_path)]), cfg, "correct", str(output_dir), workers=1)
+
+        assert (results[0].cache_hits, results[0].cache_misses) == (hits, 1 - hits)
+        assert summarize(results, elapsed).endswith(f", {hits}/1 results from the cache")
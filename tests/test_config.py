@@ -0,0 +1,28 @@
+import pytest
+
+from modules.Config import CFG
+
+
+def write_config(tmp_path, processing):
+    path = tmp_path / "config.cfg"
+    path.write_text("[PROCESSING]\n" + processing + "\n[DISCOVERY]\nalbedo = *_col\n")
+    return str(path)
+
+
+def test_malformed_value_keeps_other_settings(tmp_path):
+    with pytest.warns(UserWarning, match="threads"):
+        cfg = CFG(write_config(tmp_path, "threads = two\nio_threads = 4\n"))
+
+    assert cfg.threads == 1
+    assert cfg.io_threads == 4
+    assert cfg.texture_patterns["albedo"] == ["*_col"]
+
+
+@pytest.mark.parametrize("key", ["kernel", "transfer", "engine"])
+def test_unknown_choice_falls_back(tmp_path, key):
+    default = getattr(CFG(str(tmp_path / "missing.cfg")), key)
+
+    with pytest.warns(UserWarning, match="expected one of"):
+        cfg = CFG(write_config(tmp_path, f"{key} = typo\n"))
+
+    assert getattr(cfg, key) == default
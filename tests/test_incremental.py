@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.PBR import PBRSet
+
+
+@pytest.mark.parametrize("transfer", ["exact", "lut", "numpy"])
+def test_incremental_matches_full_evaluation(transfer):
+    rng = np.random.default_rng(2)
+    albedo = Image.fromarray(rng.integers(0, 256, (40, 33, 3), dtype=np.uint8))
+    metallic = Image.fromarray(rng.integers(0, 256, (40, 33), dtype=np.uint8))
+    incremental_set = PBRSet(albedo, metallic, transfer=transfer, tile_rows=16, incremental=True)
+
+    # the second limits are answered from the kept luminance
+    for limit_values in ([8, 235, 52], [30, 200, 60]):
+        for mode in ["nonmetallic", "metallic", "combined"]:
+            pbr_set = PBRSet(albedo, metallic, transfer=transfer)
+            pbr_set.correct_albedo(mode, limit_values)
+            incremental_set.correct_albedo(mode, limit_values)
+
+            assert np.array_equal(np.asarray(pbr_set.albedo_corrected), np.asarray(incremental_set.albedo_corrected))
+            assert pbr_set.verify_albedo(limit_values, mode) == incremental_set.verify_albedo(limit_values, mode)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.PBR import PBRSet, stage_lut
+from modules.Stack import correct_stack, verify_stack
+
+LIMIT_VALUES = [8, 235, 52]
+
+
+def texture_set(seed):
+    rng = np.random.default_rng(seed)
+    mask_data = rng.integers(0, 256, (48, 40), dtype=np.uint8)
+    mask_data[:16] = 0
+    mask_data[16:32] = 255
+
+    return (Image.fromarray(rng.integers(0, 256, (48, 40, 3), dtype=np.uint8)), Image.fromarray(mask_data),
+            Image.fromarray(rng.integers(0, 256, (48, 40, 3), dtype=np.uint8)))
+
+
+@pytest.mark.parametrize("mode", ["nonmetallic", "metallic", "combined"])
+def test_lattice_stack_matches_per_set(mode):
+    images = [texture_set(seed) for seed in range(3)]
+    stacked = [PBRSet(*textures, engine="lut", lut_size=33) for textures in images]
+    correct_stack(stacked, mode, LIMIT_VALUES, True)
+
+    for textures, stacked_set in zip(images, stacked):
+        pbr_set = PBRSet(*textures, engine="lut", lut_size=33)
+        pbr_set.correct_albedo(mode, LIMIT_VALUES, True)
+
+        assert np.array_equal(np.asarray(pbr_set.albedo_corrected), np.asarray(stacked_set.albedo_corrected))
+        assert np.array_equal(np.asarray(pbr_set.roughness_corrected), np.asarray(stacked_set.roughness_corrected))
+
+
+@pytest.mark.parametrize("mode", ["nonmetallic", "metallic", "combined"])
+def test_lattice_verification_is_exact(mode):
+    textures = texture_set(0)
+    expected = PBRSet(*textures).verify_albedo(LIMIT_VALUES, mode)
+    pbr_set = PBRSet(*textures, engine="lut", lut_size=33)
+
+    assert pbr_set.verify_albedo(LIMIT_VALUES, mode) == expected
+    assert verify_stack([PBRSet(*textures, engine="lut", lut_size=33)], LIMIT_VALUES, mode) == [expected]
+
+
+@pytest.mark.parametrize("stage", ["correct", "metallic"])
+def test_threaded_bake_matches(stage):
+    args = (tuple(LIMIT_VALUES),)
+
+    assert np.array_equal(stage_lut(stage, args, "reference", "exact", 33, 3),
+                          stage_lut(stage, args, "reference", "exact", 33, 1))
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from modules.ImageProcessing import apply_by_mask, blend_by_mask, unclamp_brightness_data
+
+
+@pytest.mark.parametrize("coverage, softness", [(0.1, 0.0), (0.25, 1.0), (0.5, 0.5), (0.95, 0.0), (1.0, 0.05)])
+def test_apply_by_mask_matches_dense_blend(coverage, softness):
+    # the coverages reach the gather, the dense fallback and the compute-all branches
+    rng = np.random.default_rng(0)
+    image_data = rng.integers(0, 256, (128, 96, 3), dtype=np.uint8)
+    covered = rng.random(image_data.shape[:2]) < coverage
+    soft = rng.random(image_data.shape[:2]) < softness
+    mask_data = np.where(covered, np.where(soft, rng.integers(1, 255, covered.shape), 255), 0).astype(np.uint8)
+
+    expected = blend_by_mask(image_data, unclamp_brightness_data(image_data, 52), mask_data)
+
+    assert np.array_equal(apply_by_mask(image_data, mask_data, unclamp_brightness_data, 52), expected)
@@ -0,0 +1,16 @@
+import pytest
+
+from modules.Memory import calibrate_memory_model, model_key, traced_peak
+
+OPTIONS = (("engine", "auto"),)
+
+
+@pytest.mark.parametrize("size, colors", [(128, None), (256, 16), (896, None)])
+@pytest.mark.parametrize("task, mode, is_compensating", [("correct", "combined", True), ("verify", "metallic", False)])
+def test_model_covers_traced_peak(size, colors, task, mode, is_compensating):
+    bytes_per_pixel, fixed_bytes = calibrate_memory_model(OPTIONS)[model_key(task, mode, is_compensating)]
+
+    # the fixed color tables of the auto engine stay out of the bytes per pixel
+    assert bytes_per_pixel < 256
+    assert traced_peak(OPTIONS, size, task, mode, is_compensating, colors) <= bytes_per_pixel * size * size + \
+        fixed_bytes
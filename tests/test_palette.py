@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import modules.PBR
+from modules.ImageProcessing import PALETTE_MIN_PIXELS
+from modules.PBR import PBRSet
+
+LIMIT_VALUES = [8, 235, 52]
+
+
+def palette_textures(size):
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (64, 3), dtype=np.uint8)
+    albedo = Image.fromarray(colors[rng.integers(0, 64, (size, size))])
+    metallic = Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8))
+
+    return albedo, metallic
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    calls = []
+    color_keys = modules.PBR.color_keys
+    monkeypatch.setattr(modules.PBR, "color_keys", lambda image_data: calls.append(1) or color_keys(image_data))
+
+    return calls
+
+
+@pytest.mark.parametrize("mode", ["nonmetallic", "metallic", "combined"])
+def test_auto_counts_once_and_matches_dense(counted, mode):
+    albedo, metallic = palette_textures(256)
+    dense = PBRSet(albedo, metallic, engine="dense")
+    auto = PBRSet(albedo, metallic, engine="auto")
+
+    for pbr_set in [dense, auto]:
+        pbr_set.correct_albedo(mode, LIMIT_VALUES)
+        pbr_set.verify_albedo(LIMIT_VALUES, mode)
+        pbr_set.correct_albedo(mode, [16, 200, 60])
+
+    assert len(counted) == 1
+    assert auto.albedo_palette is not None
+    assert np.array_equal(np.asarray(auto.albedo_corrected), np.asarray(dense.albedo_corrected))
+    assert np.array_equal(np.asarray(auto.albedo_verified), np.asarray(dense.albedo_verified))
+
+
+def test_auto_skips_count_for_small_textures(counted):
+    albedo, metallic = palette_textures(int(PALETTE_MIN_PIXELS ** 0.5) - 1)
+    pbr_set = PBRSet(albedo, metallic, engine="auto")
+    pbr_set.correct_albedo("combined", LIMIT_VALUES)
+
+    assert counted == []
+    assert pbr_set.albedo_palette is None
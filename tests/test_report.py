@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.Batch import find_texture_sets
+from modules.Config import CFG
+from modules.Report import report_texture_set
+
+
+def texture_record(tmp_path, image_data, mode, prepass_size=64):
+    Image.fromarray(image_data).save(os.path.join(tmp_path, "test_albedo.tga"))
+    texture_set, = find_texture_sets([str(tmp_path)])
+    cfg = CFG("config.cfg")
+    cfg.mode = mode
+    cfg.is_compensating = False
+
+    return report_texture_set((texture_set, cfg, prepass_size))
+
+
+@pytest.mark.parametrize("mode", ["nonmetallic", "metallic"])
+def test_prepass_passes_compliant_texture(tmp_path, mode):
+    rng = np.random.default_rng(0)
+    image_data = rng.integers(120, 136, (512, 512, 3), dtype=np.uint8)
+    record = texture_record(tmp_path, image_data, mode)
+
+    assert record["checked"] == "bounds"
+    assert record["below_min"] == record["above_max"] == 0
+    assert "luminance_p50" not in record
+
+
+@pytest.mark.parametrize("mode", ["nonmetallic", "metallic"])
+def test_prepass_keeps_isolated_texels(tmp_path, mode):
+    # one black texel in a hundred disappears in a block mean, not in the block minimum
+    rng = np.random.default_rng(0)
+    image_data = np.full((512, 512, 3), 128, dtype=np.uint8)
+    image_data.reshape(-1, 3)[rng.choice(512 * 512, 512 * 512 // 100, replace=False)] = 0
+    record = texture_record(tmp_path, image_data, mode)
+
+    assert record["checked"] == "full"
+    assert record["below_min"] == 512 * 512 // 100
+    assert record["percent_correct"] == 99.0
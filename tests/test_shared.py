@@ -0,0 +1,46 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.PBR import PBRSet
+from modules.Shared import SharedBuffers, SharedExecutor
+
+LIMIT_VALUES = [8, 235, 52]
+
+
+def test_free_blocks_are_capped():
+    buffers = SharedBuffers(max_free_bytes=3000)
+    descriptors = [buffers.empty((size,)) for size in [1000, 1500, 2000, 1000]]
+    names = [descriptor[0] for descriptor in descriptors]
+
+    for descriptor in descriptors:
+        buffers.release(descriptor)
+
+    # the 1000 and 1500 byte blocks released first are unlinked, the rest stays for reuse
+    assert list(buffers.free) == names[2:]
+    for name in names[:2]:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    assert buffers.empty((1000,))[0] == names[3]
+    buffers.close()
+
+
+def test_executor_without_free_pool():
+    rng = np.random.default_rng(0)
+    images = [(Image.fromarray(rng.integers(0, 256, (32 + index, 24, 3), dtype=np.uint8)),
+               Image.fromarray(rng.integers(0, 256, (32 + index, 24), dtype=np.uint8))) for index in range(3)]
+
+    with SharedExecutor(1, max_free_bytes=0) as executor:
+        for albedo, metallic in images:
+            job = executor.submit("correct", albedo, metallic, mode="combined", limit_values=LIMIT_VALUES)
+            outputs, _ = executor.wait(job)
+            pbr_set = PBRSet(albedo, metallic)
+            pbr_set.correct_albedo("combined", LIMIT_VALUES)
+
+            assert np.array_equal(outputs["albedo"], np.asarray(pbr_set.albedo_corrected))
+            executor.release(job)
+
+        assert not executor.buffers.blocks
@@ -0,0 +1,51 @@
+import numpy as np
+
+from modules.ImageProcessing import TRANSFER_FUNCTIONS, correct_range_reference, linear_to_srgb, srgb_to_linear
+
+LIMIT_VALUES = [8, 235]
+
+# every 8-bit level, as the float32 input the kernels decode
+LEVELS = np.arange(256, dtype=np.float32)
+
+# a dense sweep of linear values, including both ends and the branch point of the curve
+LINEAR = np.concatenate((np.linspace(0, 255, 1 << 20), [0.0031308 * 255, 255]))
+
+
+def test_lut_decode_is_exact():
+    decode = TRANSFER_FUNCTIONS["lut"][0]
+
+    assert np.array_equal(decode(LEVELS.astype(np.uint8)), srgb_to_linear(LEVELS))
+    assert np.array_equal(decode(LEVELS), srgb_to_linear(LEVELS))
+
+
+def test_lut_encode_within_one_level():
+    encode = TRANSFER_FUNCTIONS["lut"][1]
+    exact = linear_to_srgb(LINEAR)
+    encoded = encode(LINEAR)
+
+    # the table is documented to stay within 0.005 of the curve, so truncation moves a pixel by one level at most
+    assert np.abs(encoded - exact).max() <= 0.005
+    assert np.abs(encoded.astype(np.uint8).astype(np.int16) - exact.astype(np.uint8)).max() <= 1
+
+
+def test_lut_encode_is_not_biased_down():
+    # interpolation under a concave curve used to take a level off almost half of the corrected channels
+    rng = np.random.default_rng(0)
+    image_data = rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    exact = correct_range_reference(image_data, LIMIT_VALUES, transfer="exact").astype(np.int16)
+    difference = correct_range_reference(image_data, LIMIT_VALUES, transfer="lut").astype(np.int16) - exact
+
+    assert (TRANSFER_FUNCTIONS["lut"][1](LINEAR) >= linear_to_srgb(LINEAR)).all()
+    # a pixel the correction leaves alone keeps its level
+    assert np.array_equal(TRANSFER_FUNCTIONS["lut"][1](srgb_to_linear(LEVELS)).astype(np.uint8), LEVELS)
+    assert np.count_nonzero(difference < 0) == 0
+    assert abs(difference.mean()) < 0.01
+
+
+def test_numpy_transfer_matches_exact():
+    decode, encode = TRANSFER_FUNCTIONS["numpy"]
+    exact = linear_to_srgb(LINEAR)
+
+    assert np.allclose(decode(LEVELS), srgb_to_linear(LEVELS), rtol=0, atol=1e-9)
+    assert np.allclose(encode(LINEAR), exact, rtol=0, atol=1e-9)
+    assert np.array_equal(encode(LINEAR).astype(np.uint8), exact.astype(np.uint8))